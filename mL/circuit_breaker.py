@@ -0,0 +1,52 @@
+import time
+from typing import Tuple
+
+class CircuitBreaker:
+    """
+    Classic closed / open / half-open breaker. While open, calls fail fast; after the
+    cool-down a single probe call is let through and its outcome decides the next state.
+    A probe abandoned without an outcome (e.g. cancelled) releases its slot for the next call.
+    """
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.stats = {"successes": 0, "failures": 0, "short_circuited": 0, "times_opened": 0}
+
+    def allow_request(self) -> Tuple[bool, bool]:
+        """Whether a call may go ahead, and whether it is the half-open probe."""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.stats["short_circuited"] += 1
+                return False, False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                self.stats["short_circuited"] += 1
+                return False, False
+            self.probe_in_flight = True
+            return True, True
+        return True, False
+
+    def release_probe(self):
+        """Give up the probe slot without recording an outcome, so the next call probes instead."""
+        self.probe_in_flight = False
+
+    def record_success(self):
+        self.stats["successes"] += 1
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+        self.state = "closed"
+
+    def record_failure(self):
+        self.stats["failures"] += 1
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.stats["times_opened"] += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
@@ -0,0 +1,48 @@
+import asyncio
+import json
+import random
+import time
+from typing import Dict
+
+import aiohttp
+
+class RetryableLLMError(Exception):
+    """Transient Gemini failure (timeout, connection error, 429 or 5xx) worth retrying."""
+
+async def call_gemini(
+    apiUrl: str,
+    payload: Dict,
+    deadline: float,
+    attempt_timeout: float,
+    max_retries: int,
+    retry_base_delay: float
+) -> str:
+    """Post to Gemini with a per-attempt timeout and bounded, jittered retries within an overall deadline."""
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RetryableLLMError("LLM deadline exceeded")
+        try:
+            timeout = aiohttp.ClientTimeout(total=min(attempt_timeout, remaining))
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.post(apiUrl, headers={'Content-Type': 'application/json'}, data=json.dumps(payload)) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise RetryableLLMError(f"HTTP {response.status}")
+                    response.raise_for_status() # Other HTTP errors are not retried
+                    result = await response.json()
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError, RetryableLLMError) as e:
+            attempt += 1
+            if attempt > max_retries:
+                raise RetryableLLMError(f"LLM call failed after {attempt} attempts: {e!r}")
+            # Exponential backoff with full jitter, never sleeping past the deadline
+            delay = random.uniform(0, retry_base_delay * 2 ** (attempt - 1))
+            await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            continue
+        
+        if result.get("candidates") and len(result["candidates"]) > 0 and \
+           result["candidates"][0].get("content") and \
+           result["candidates"][0]["content"].get("parts") and \
+           len(result["candidates"][0]["content"]["parts"]) > 0:
+            return result["candidates"][0]["content"]["parts"][0]["text"]
+        raise ValueError(f"LLM response structure unexpected: {result}")
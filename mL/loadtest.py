@@ -0,0 +1,323 @@
+"""
+Load and soak test harness for the Beach Cleanliness Analyzer.
+
+Starts a local stub image server and a local Gemini-compatible stub, launches the
+analyzer against them (or targets an already running instance), drives /analyze at
+a fixed request rate and concurrency, and reports throughput, latency percentiles,
+error rates and RSS growth.
+
+Everything runs offline. The CLIP weights must already be in the local Hugging Face
+cache, as the spawned service is started with HF_HUB_OFFLINE=1.
+
+Example:
+    python loadtest.py --rate 2 --concurrency 4 --duration 60
+    python loadtest.py --rate 1 --duration 3600 --report-interval 60 --llm-failure-rate 0.1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Image stub
+
+def make_beach_image(width: int, height: int, seed: int = 0) -> bytes:
+    """Render a synthetic beach scene (sky, sea, sand, scattered debris) as JPEG bytes."""
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), "#87CEEB") # Sky
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, height * 0.3, width, height * 0.55], fill="#1E6091") # Sea
+    draw.rectangle([0, height * 0.55, width, height], fill="#E8D3A2") # Sand
+
+    # Scatter some colourful blobs on the sand so the detection path gets exercised
+    for _ in range(rng.randint(0, 12)):
+        x = rng.randint(0, width - 40)
+        y = rng.randint(int(height * 0.6), height - 40)
+        size = rng.randint(15, max(16, width // 20))
+        color = rng.choice(["#FF4444", "#FFFFFF", "#32CD32", "#1E90FF", "#FFA500"])
+        draw.ellipse([x, y, x + size, y + size // 2], fill=color)
+
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+def create_image_stub(args: argparse.Namespace) -> web.Application:
+    """Serve /image/{width}x{height}/{seed}.jpg with configurable latency and failures."""
+    cache: Dict[str, bytes] = {}
+
+    async def handle_image(request: web.Request) -> web.Response:
+        await asyncio.sleep(max(0.0, random.gauss(args.image_latency_ms, args.image_latency_ms * 0.2)) / 1000)
+        if random.random() < args.image_failure_rate:
+            return web.Response(status=503, text="stub image failure")
+
+        width, height = (int(v) for v in request.match_info["size"].split("x"))
+        key = f"{width}x{height}/{request.match_info['seed']}"
+        if key not in cache:
+            cache[key] = make_beach_image(width, height, seed=int(request.match_info["seed"]))
+        return web.Response(body=cache[key], content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/image/{size}/{seed}.jpg", handle_image)
+    return app
+
+# Gemini stub
+
+def create_gemini_stub(args: argparse.Namespace) -> web.Application:
+    """Mimic the Gemini generateContent endpoint with configurable latency, failures and hangs."""
+
+    async def handle_generate(request: web.Request) -> web.Response:
+        await request.read()
+        if random.random() < args.llm_hang_rate:
+            await asyncio.sleep(args.llm_hang_seconds) # Simulate a degraded upstream that never answers in time
+        await asyncio.sleep(max(0.0, random.gauss(args.llm_latency_ms, args.llm_latency_ms * 0.2)) / 1000)
+        if random.random() < args.llm_failure_rate:
+            return web.json_response({"error": {"code": 503, "message": "stub overloaded"}}, status=503)
+
+        return web.json_response({
+            "candidates": [{
+                "content": {
+                    "role": "model",
+                    "parts": [{"text": "- Organise a targeted cleanup of plastic debris\n- Install waste bins near access points\n- Monitor the beach monthly"}]
+                }
+            }]
+        })
+
+    app = web.Application()
+    app.router.add_post("/v1beta/models/{model_action}", handle_generate)
+    return app
+
+async def start_app(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+# Service under test
+
+def spawn_service(args: argparse.Namespace) -> subprocess.Popen:
+    """Start the analyzer with uvicorn, wired to the local stubs."""
+    env = dict(os.environ)
+    env.update({
+        "GEMINI_API_KEY": "stub-key",
+        "GEMINI_API_BASE_URL": f"http://{args.host}:{args.llm_port}",
+        "HF_HUB_OFFLINE": "1",
+        "TRANSFORMERS_OFFLINE": "1",
+        "EMBEDDING_STORE_DIR": "", # Keep synthetic load-test images out of the real embedding store
+    })
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", args.host, "--port", str(args.service_port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env
+    )
+
+async def wait_until_healthy(session: aiohttp.ClientSession, base_url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{base_url}/health") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(1)
+    raise RuntimeError(f"Service at {base_url} did not become healthy within {timeout:.0f}s")
+
+def read_rss_mb(pid: int) -> Optional[float]:
+    """Resident set size of a process in MB, read from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+# Load driver
+
+def summarize(latencies: List[float], statuses: Dict[str, int], elapsed: float) -> Dict:
+    total = sum(statuses.values())
+    errors = total - statuses.get("200", 0)
+    summary = {
+        "requests": total,
+        "throughput_rps": total / elapsed if elapsed > 0 else 0.0,
+        "error_rate": errors / total if total else 0.0,
+        "status_counts": dict(statuses),
+    }
+    if latencies:
+        lat = np.array(latencies) * 1000
+        summary["latency_ms"] = {
+            "mean": float(lat.mean()),
+            "p50": float(np.percentile(lat, 50)),
+            "p90": float(np.percentile(lat, 90)),
+            "p99": float(np.percentile(lat, 99)),
+            "max": float(lat.max()),
+        }
+    return summary
+
+async def run_load(args: argparse.Namespace, base_url: str, service_pid: Optional[int]) -> Dict:
+    """Issue requests on a fixed schedule; latency is measured from the scheduled start time
+    so that queueing behind the concurrency limit is not hidden (no coordinated omission)."""
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    window_latencies: List[float] = []
+    window_statuses: Dict[str, int] = {}
+    rss_samples: List[float] = []
+    tasks = set() # In-flight requests only; finished tasks are dropped so long soaks don't accumulate them
+
+    def record(status: str, latency: float) -> None:
+        for lat_list, status_dict in ((latencies, statuses), (window_latencies, window_statuses)):
+            lat_list.append(latency)
+            status_dict[status] = status_dict.get(status, 0) + 1
+
+    async def one_request(session: aiohttp.ClientSession, index: int, scheduled: float) -> None:
+        width, height = random.choice(args.image_sizes)
+        payload = {
+            "image_url": f"http://{args.host}:{args.image_port}/image/{width}x{height}/{index % args.distinct_images}.jpg",
+            "return_annotated_image": args.annotate,
+        }
+        async with semaphore:
+            try:
+                async with session.post(f"{base_url}/analyze", json=payload) as response:
+                    await response.read()
+                    status = str(response.status)
+            except asyncio.TimeoutError:
+                status = "timeout"
+            except aiohttp.ClientError as e:
+                status = type(e).__name__
+        record(status, time.monotonic() - scheduled)
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=args.request_timeout)) as session:
+        start = time.monotonic()
+        next_report = start + args.report_interval
+        interval = 1.0 / args.rate
+        index = 0
+        while True:
+            scheduled = start + index * interval
+            if scheduled - start >= args.duration:
+                break
+            now = time.monotonic()
+            if scheduled > now:
+                await asyncio.sleep(scheduled - now)
+            task = asyncio.create_task(one_request(session, index, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            index += 1
+
+            if service_pid is not None:
+                rss = read_rss_mb(service_pid)
+                if rss is not None and (not rss_samples or time.monotonic() - start >= len(rss_samples) * args.rss_interval):
+                    rss_samples.append(rss)
+
+            if time.monotonic() >= next_report:
+                window = summarize(window_latencies, window_statuses, args.report_interval)
+                rss_now = rss_samples[-1] if rss_samples else None
+                print(f"[{time.monotonic() - start:7.0f}s] {json.dumps(window)} rss_mb={rss_now}", flush=True)
+                window_latencies.clear()
+                window_statuses.clear()
+                next_report += args.report_interval
+
+        await asyncio.gather(*list(tasks))
+        elapsed = time.monotonic() - start
+
+    summary = summarize(latencies, statuses, elapsed)
+    summary["config"] = {"rate": args.rate, "concurrency": args.concurrency, "duration": args.duration}
+    if service_pid is not None:
+        final_rss = read_rss_mb(service_pid)
+        if final_rss is not None:
+            rss_samples.append(final_rss)
+        if rss_samples:
+            summary["rss_mb"] = {
+                "start": rss_samples[0],
+                "end": rss_samples[-1],
+                "peak": max(rss_samples),
+                "growth": rss_samples[-1] - rss_samples[0],
+            }
+    return summary
+
+async def main(args: argparse.Namespace) -> Dict:
+    image_runner = await start_app(create_image_stub(args), args.host, args.image_port)
+    llm_runner = await start_app(create_gemini_stub(args), args.host, args.llm_port)
+    service = None
+    try:
+        if args.target:
+            base_url = args.target.rstrip("/")
+            service_pid = args.service_pid
+        else:
+            service = spawn_service(args)
+            base_url = f"http://{args.host}:{args.service_port}"
+            service_pid = service.pid
+
+        async with aiohttp.ClientSession() as session:
+            await wait_until_healthy(session, base_url, args.startup_timeout)
+
+        # Warm up so model initialisation is not counted against the run
+        for _ in range(args.warmup):
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f"{base_url}/analyze", json={
+                    "image_url": f"http://{args.host}:{args.image_port}/image/800x600/0.jpg",
+                    "return_annotated_image": False,
+                }) as response:
+                    await response.read()
+
+        return await run_load(args, base_url, service_pid)
+    finally:
+        if service is not None:
+            service.terminate()
+            try:
+                service.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                service.kill()
+        await image_runner.cleanup()
+        await llm_runner.cleanup()
+
+def parse_size(value: str) -> tuple:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load and soak test for the beach analyzer")
+    parser.add_argument("--rate", type=float, default=1.0, help="Requests per second (fixed schedule)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum in-flight requests")
+    parser.add_argument("--duration", type=float, default=60.0, help="Run length in seconds")
+    parser.add_argument("--warmup", type=int, default=1, help="Warm-up requests before measuring")
+    parser.add_argument("--report-interval", type=float, default=30.0, help="Seconds between interim reports")
+    parser.add_argument("--rss-interval", type=float, default=5.0, help="Seconds between RSS samples")
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--startup-timeout", type=float, default=180.0)
+    parser.add_argument("--image-sizes", type=parse_size, nargs="+", default=[(800, 600), (1920, 1080)])
+    parser.add_argument("--distinct-images", type=int, default=20, help="Number of distinct image URLs to cycle through")
+    parser.add_argument("--annotate", action="store_true", help="Request annotated images")
+    parser.add_argument("--image-latency-ms", type=float, default=20.0)
+    parser.add_argument("--image-failure-rate", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=800.0)
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--llm-hang-rate", type=float, default=0.0, help="Fraction of LLM calls that stall")
+    parser.add_argument("--llm-hang-seconds", type=float, default=60.0)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--image-port", type=int, default=8101)
+    parser.add_argument("--llm-port", type=int, default=8102)
+    parser.add_argument("--service-port", type=int, default=8100)
+    parser.add_argument("--target", help="Base URL of an already running service (skips spawning one; start it with GEMINI_API_BASE_URL pointing at the LLM stub and EMBEDDING_STORE_DIR empty)")
+    parser.add_argument("--service-pid", type=int, help="PID of the --target service, for RSS tracking")
+    parser.add_argument("--json-out", help="Write the final summary to this file")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    summary = asyncio.run(main(args))
+    print(json.dumps(summary, indent=2))
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(summary, f, indent=2)
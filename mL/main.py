@@ -1,5 +1,5 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse
 from pydantic import BaseModel
 import torch
 from PIL import Image, ImageDraw, ImageFont
@@ -7,17 +7,29 @@ import requests
 from transformers import CLIPProcessor, CLIPModel
 from io import BytesIO
 import numpy as np
-from typing import Dict, List, Tuple, Optional
+from typing import AsyncIterator, Dict, Iterator, List, NamedTuple, Tuple, Optional
 import asyncio
 import aiohttp
 from urllib.parse import urlparse
 import math
+import threading
+import time
+import uuid
+import hmac
+from contextlib import aclosing, contextmanager, nullcontext
+from functools import lru_cache
+from contextvars import ContextVar
 import cv2
 from sklearn.cluster import DBSCAN # Keep DBSCAN for potential future use or more advanced clustering
 import base64
+import hashlib
+import weakref
 import json # For parsing JSON from LLM
 import os # Import the os module to access environment variables
 from dotenv import load_dotenv # Import load_dotenv
+from single_flight import SingleFlight
+from circuit_breaker import CircuitBreaker
+from llm_client import RetryableLLMError, call_gemini
 load_dotenv() # Load environment variables from .env file
 
 app = FastAPI(title="Advanced Beach Cleanliness Analyzer", version="3.0")
@@ -27,9 +39,68 @@ app = FastAPI(title="Advanced Beach Cleanliness Analyzer", version="3.0")
 model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
 processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
 
+# Gemini endpoint (override to point at a local stub, e.g. for load testing)
+GEMINI_API_BASE_URL = os.environ.get("GEMINI_API_BASE_URL", "https://generativelanguage.googleapis.com").rstrip("/")
+
+# Gemini call policy: per-attempt timeout, bounded retries with jitter and an overall deadline
+LLM_ATTEMPT_TIMEOUT = float(os.environ.get("LLM_ATTEMPT_TIMEOUT", "8"))
+LLM_TOTAL_DEADLINE = float(os.environ.get("LLM_TOTAL_DEADLINE", "15"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.5"))
+# Circuit breaker: after this many consecutive failures, skip Gemini for the cool-down period
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))
+
+# On-demand profiling: requests carrying this token (X-Profile-Token header or profile_token field) are profiled
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN", "") # Empty disables profiling
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_MAX_TRACES = int(os.environ.get("PROFILE_MAX_TRACES", "20"))
+
+# Embedding store: every analyzed image's CLIP embeddings are kept so scores can be recomputed offline
+DEFAULT_EMBEDDING_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "embeddings")
+EMBEDDING_STORE_DIR = os.environ.get("EMBEDDING_STORE_DIR", DEFAULT_EMBEDDING_STORE_DIR) # Empty disables the store
+
+# Optional JSON file of calibrated per-category detection thresholds
+CATEGORY_THRESHOLDS_PATH = os.environ.get("CATEGORY_THRESHOLDS_PATH", "")
+
+# Early-exit cascade configuration
+# Clearly clean beaches skip the per-category scan and localization entirely.
+EARLY_EXIT_ENABLED = os.environ.get("EARLY_EXIT_ENABLED", "true").lower() in ("1", "true", "yes")
+EARLY_EXIT_CLEAN_CONFIDENCE = float(os.environ.get("EARLY_EXIT_CLEAN_CONFIDENCE", "0.85")) # P(clean) vs P(polluted)
+EARLY_EXIT_MIN_NATURAL_RATIO = float(os.environ.get("EARLY_EXIT_MIN_NATURAL_RATIO", "0.7"))
+
+# Running counters reported by /stats
+cascade_stats = {"requests": 0, "early_exits": 0}
+
+# Memory budget and admission control
+MEMORY_BUDGET_MB = float(os.environ.get("MEMORY_BUDGET_MB", "2048")) # Shared by all in-flight requests
+MEMORY_REQUEST_OVERHEAD_MB = float(os.environ.get("MEMORY_REQUEST_OVERHEAD_MB", "64")) # Size-independent costs: CLIP activations, tokenizer, etc.
+MEMORY_QUEUE_TIMEOUT = float(os.environ.get("MEMORY_QUEUE_TIMEOUT", "30")) # Seconds a request may wait for budget
+MEMORY_MAX_QUEUED = int(os.environ.get("MEMORY_MAX_QUEUED", "16"))
+MEMORY_SAMPLE_INTERVAL_MS = float(os.environ.get("MEMORY_SAMPLE_INTERVAL_MS", "5")) # 0 disables per-stage tracking
+MEMORY_CALIBRATION_WARMUP = int(os.environ.get("MEMORY_CALIBRATION_WARMUP", "3")) # Samples per stage ignored while caches warm up
+MEMORY_CALIBRATION_MAX_STEP = 1.5 # One sample can raise a stage estimate by at most this factor
+MIN_IMAGE_SIDE = 100
+MAX_IMAGE_SIDE = 4000 # Larger images are downscaled to MAX_ANALYSIS_SIDE before analysis
+MAX_ANALYSIS_SIDE = 2000
+
+# Initial bytes-per-pixel estimates for each pipeline stage, refined from measured peaks.
+# decode: compressed buffer + decoded RGB + conversion copy
+# detection: float attention map + normalized copies + uint8/binary maps in find_object_regions
+# annotation: image copy + JPEG/base64 encoding
+DEFAULT_STAGE_BYTES_PER_PIXEL = {
+    "decode": 8.0,
+    "characteristics": 1.0,
+    "natural_artificial": 1.0,
+    "detection": 24.0,
+    "annotation": 8.0
+}
+
 class AnalyzeRequest(BaseModel):
     image_url: str
     return_annotated_image: bool = True
+    allow_early_exit: bool = True # Set to false to always run full localization
+    profile_token: Optional[str] = None # Privileged: record a per-request trace (see PROFILING_TOKEN)
 
 class BoundingBox(BaseModel):
     x: int
@@ -51,8 +122,9 @@ class AnalysisResponse(BaseModel):
     detected_objects: List[ObjectDetection]
     beach_characteristics: Dict
     detailed_analysis: Dict
-    recommendations: str # This will now come from LLM
+    recommendations: str # From the LLM, or local rule-based fallback when it is unavailable
     annotated_image_base64: Optional[str] = None
+    profile_trace_id: Optional[str] = None # Set on profiled requests; fetch from /profiles/{id}
 
 def validate_image_url(url: str) -> bool:
     """Validate if the URL is properly formatted"""
@@ -62,8 +134,221 @@ def validate_image_url(url: str) -> bool:
     except:
         return False
 
-async def download_image(url: str) -> Image.Image:
-    """Download image asynchronously with better error handling"""
+def read_rss_bytes() -> Optional[int]:
+    """Current resident set size of this process, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+class MemorySampler:
+    """
+    Background thread that polls RSS so that short-lived peaks inside a stage are captured.
+    Analysis stages run synchronously on the event loop, so a stage owns the peak between reset() and peak().
+    """
+    def __init__(self, interval_ms: float):
+        self.interval = interval_ms / 1000
+        self.enabled = interval_ms > 0 and read_rss_bytes() is not None
+        self._peak = 0
+        self._lock = threading.Lock()
+        if self.enabled:
+            threading.Thread(target=self._run, name="memory-sampler", daemon=True).start()
+
+    def _run(self):
+        while True:
+            rss = read_rss_bytes() or 0
+            with self._lock:
+                if rss > self._peak:
+                    self._peak = rss
+            time.sleep(self.interval)
+
+    def reset(self) -> int:
+        rss = read_rss_bytes() or 0
+        with self._lock:
+            self._peak = rss
+        return rss
+
+    def peak(self) -> int:
+        rss = read_rss_bytes() or 0
+        with self._lock:
+            return max(self._peak, rss)
+
+memory_sampler = MemorySampler(MEMORY_SAMPLE_INTERVAL_MS)
+
+# Per-stage calibration state: estimate in use plus what was actually observed
+stage_memory = {
+    stage: {"bytes_per_pixel": bpp, "samples": 0, "max_observed_bytes_per_pixel": 0.0, "last_peak_mb": 0.0}
+    for stage, bpp in DEFAULT_STAGE_BYTES_PER_PIXEL.items()
+}
+
+@contextmanager
+def memory_stage(stage: str, pixels: int):
+    """Measure the peak RSS growth of a pipeline stage and fold it into the per-stage estimate."""
+    if not memory_sampler.enabled:
+        yield
+        return
+    baseline = memory_sampler.reset()
+    try:
+        yield
+    finally:
+        peak_bytes = max(0, memory_sampler.peak() - baseline)
+        entry = stage_memory[stage]
+        entry["samples"] += 1
+        entry["last_peak_mb"] = peak_bytes / 2**20
+        # The first requests also pay one-off costs (text feature caches, allocator and thread-pool warm-up)
+        if entry["samples"] > MEMORY_CALIBRATION_WARMUP:
+            update_stage_estimate(stage, peak_bytes, pixels)
+
+def update_stage_estimate(stage: str, peak_bytes: int, pixels: int):
+    """Fold one measured stage peak (RSS growth in bytes) into the stage's bytes-per-pixel estimate."""
+    entry = stage_memory[stage]
+    # Size-independent costs (model forward passes, scratch buffers) are covered by MEMORY_REQUEST_OVERHEAD_MB;
+    # only growth beyond it scales with the image, otherwise small images would inflate the per-pixel rate.
+    observed = max(0, peak_bytes - MEMORY_REQUEST_OVERHEAD_MB * 2**20) / max(pixels, 1)
+    entry["max_observed_bytes_per_pixel"] = max(entry["max_observed_bytes_per_pixel"], observed)
+    # Move quickly towards larger observations and slowly towards smaller ones, so estimates stay conservative,
+    # but never by more than MEMORY_CALIBRATION_MAX_STEP per sample so one outlier cannot shut out large images.
+    # RSS rarely drops once buffers are freed (they stay in the allocator), so later requests often measure ~0;
+    # calibration may therefore only raise an estimate above its default, never lower it.
+    weight = 0.5 if observed > entry["bytes_per_pixel"] else 0.05
+    entry["bytes_per_pixel"] = max(
+        DEFAULT_STAGE_BYTES_PER_PIXEL[stage],
+        min(
+            entry["bytes_per_pixel"] * MEMORY_CALIBRATION_MAX_STEP,
+            entry["bytes_per_pixel"] + weight * (observed - entry["bytes_per_pixel"])
+        )
+    )
+
+# Set while a profiled request is running; profile_region is a no-op otherwise
+profiling_active: ContextVar[bool] = ContextVar("profiling_active", default=False)
+profiling_lock = asyncio.Lock() # The torch profiler is process-wide, so one profiled request at a time
+
+def profile_region(name: str):
+    """Label a region in the per-request trace. Costs nothing when the request is not profiled."""
+    if profiling_active.get():
+        return torch.profiler.record_function(name)
+    return nullcontext()
+
+@contextmanager
+def pipeline_stage(stage: str, pixels: int):
+    """A named pipeline stage: tracked for memory calibration and labelled in profiles."""
+    with memory_stage(stage, pixels), profile_region(stage):
+        yield
+
+def estimate_request_memory(
+    width: int,
+    height: int,
+    return_annotated_image: bool,
+    decode_pixels: Optional[int] = None
+) -> int:
+    """
+    Estimate the peak memory (bytes) a request needs for an image analyzed at the given size.
+    The decoded image is held for the whole request; stages run one after another,
+    so only the largest stage adds to it. `decode_pixels` is the size the image is actually
+    decoded at, which is the full source size for formats that cannot decode at reduced scale.
+    """
+    pixels = width * height
+    stages = ["characteristics", "natural_artificial", "detection"]
+    if return_annotated_image:
+        stages.append("annotation")
+    held_image = 4 * pixels # PIL stores RGB as 4 bytes per pixel
+    largest_stage = max(
+        max(stage_memory[stage]["bytes_per_pixel"] for stage in stages) * pixels,
+        stage_memory["decode"]["bytes_per_pixel"] * (decode_pixels or pixels)
+    )
+    return int(MEMORY_REQUEST_OVERHEAD_MB * 2**20 + held_image + largest_stage)
+
+class MemoryBudget:
+    """Global memory budget shared by all in-flight requests. Requests that do not fit wait in a bounded queue."""
+    def __init__(self, capacity_bytes: int, max_queued: int, queue_timeout: float):
+        self.capacity = capacity_bytes
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.in_use = 0
+        self.queued = 0
+        self.stats = {"admitted": 0, "queued": 0, "downscaled": 0, "rejected": 0, "peak_in_use_mb": 0.0}
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, nbytes: int):
+        async with self._condition:
+            if self.in_use + nbytes > self.capacity:
+                if self.queued >= self.max_queued:
+                    self.stats["rejected"] += 1
+                    raise HTTPException(
+                        status_code=503,
+                        detail="Server is at its memory budget and the admission queue is full; retry later",
+                        headers={"Retry-After": str(int(self.queue_timeout))}
+                    )
+                self.queued += 1
+                self.stats["queued"] += 1
+                try:
+                    await asyncio.wait_for(
+                        self._condition.wait_for(lambda: self.in_use + nbytes <= self.capacity),
+                        timeout=self.queue_timeout
+                    )
+                except asyncio.TimeoutError:
+                    self.stats["rejected"] += 1
+                    raise HTTPException(
+                        status_code=503,
+                        detail=f"Timed out after {self.queue_timeout:.0f}s waiting for memory budget; retry later",
+                        headers={"Retry-After": str(int(self.queue_timeout))}
+                    )
+                finally:
+                    self.queued -= 1
+            self.in_use += nbytes
+            self.stats["admitted"] += 1
+            self.stats["peak_in_use_mb"] = max(self.stats["peak_in_use_mb"], self.in_use / 2**20)
+
+    async def release(self, nbytes: int):
+        async with self._condition:
+            self.in_use -= nbytes
+            self._condition.notify_all()
+
+memory_budget = MemoryBudget(int(MEMORY_BUDGET_MB * 2**20), MEMORY_MAX_QUEUED, MEMORY_QUEUE_TIMEOUT)
+
+class MemoryReservation:
+    """Holds a request's share of the memory budget from admission until the request finishes."""
+    def __init__(self, budget: MemoryBudget):
+        self.budget = budget
+        self.nbytes = 0
+
+    async def acquire(self, nbytes: int):
+        await self.budget.acquire(nbytes)
+        self.nbytes = nbytes
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.nbytes:
+            await self.budget.release(self.nbytes)
+            self.nbytes = 0
+
+def plan_analysis_size(width: int, height: int, return_annotated_image: bool) -> Tuple[int, int]:
+    """
+    Pick the size an image is analyzed at: oversized images are capped at MAX_ANALYSIS_SIDE,
+    and images whose estimate alone exceeds the whole budget are downscaled until they fit.
+    """
+    if width > MAX_IMAGE_SIDE or height > MAX_IMAGE_SIDE:
+        scale = MAX_ANALYSIS_SIDE / max(width, height)
+        width, height = max(1, int(width * scale)), max(1, int(height * scale))
+
+    estimate = estimate_request_memory(width, height, return_annotated_image)
+    if estimate > memory_budget.capacity:
+        per_pixel = (estimate - MEMORY_REQUEST_OVERHEAD_MB * 2**20) / (width * height)
+        allowed_pixels = (memory_budget.capacity - MEMORY_REQUEST_OVERHEAD_MB * 2**20) / per_pixel
+        scale = math.sqrt(max(allowed_pixels, 0) / (width * height))
+        width, height = int(width * scale), int(height * scale)
+        if width < MIN_IMAGE_SIDE or height < MIN_IMAGE_SIDE:
+            memory_budget.stats["rejected"] += 1
+            raise HTTPException(status_code=413, detail="Image cannot be analyzed within the server memory budget")
+        memory_budget.stats["downscaled"] += 1
+
+    return width, height
+
+async def fetch_image_bytes(url: str) -> bytes:
+    """Download the raw image bytes asynchronously with better error handling"""
     if not validate_image_url(url):
         raise HTTPException(status_code=400, detail="Invalid URL format")
     
@@ -73,140 +358,258 @@ async def download_image(url: str) -> Image.Image:
                 if response.status != 200:
                     raise HTTPException(status_code=400, detail=f"Failed to download image: HTTP {response.status}")
                 
-                content = await response.read()
-                image = Image.open(BytesIO(content)).convert("RGB")
-                
-                # Validate image size
-                width, height = image.size
-                if width < 100 or height < 100:
-                    raise HTTPException(status_code=400, detail="Image too small for analysis")
-                if width > 4000 or height > 4000:
-                    # Resize large images to prevent memory issues and improve processing speed
-                    image.thumbnail((2000, 2000), Image.Resampling.LANCZOS)
-                
-                return image
+                return await response.read()
+    except HTTPException:
+        raise
     except aiohttp.ClientError as e:
         raise HTTPException(status_code=400, detail=f"Failed to download image: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to download image: {str(e)}")
+
+async def decode_image(
+    content: bytes,
+    reservation: Optional[MemoryReservation] = None,
+    return_annotated_image: bool = True
+) -> Image.Image:
+    """
+    Validate and decode downloaded image bytes.
+    If a reservation is given, the request is admitted against the memory budget
+    (downscaling, queueing or rejecting as needed) before the image is decoded.
+    """
+    try:
+        # Only the header is parsed here; pixel data is decoded after admission
+        image = Image.open(BytesIO(content))
+        
+        # Validate image size
+        width, height = image.size
+        if width < MIN_IMAGE_SIDE or height < MIN_IMAGE_SIDE:
+            raise HTTPException(status_code=400, detail="Image too small for analysis")
+        
+        target_width, target_height = plan_analysis_size(width, height, return_annotated_image)
+        if (target_width, target_height) != (width, height):
+            # Let JPEG decode at reduced scale instead of resizing after a full decode.
+            # Other formats (PNG, WebP, ...) ignore this and are decoded at full source size.
+            image.draft("RGB", (target_width, target_height))
+        decode_pixels = image.width * image.height # Size after draft, i.e. what decoding will allocate
+        
+        estimate = estimate_request_memory(target_width, target_height, return_annotated_image, decode_pixels)
+        if estimate > memory_budget.capacity:
+            memory_budget.stats["rejected"] += 1
+            raise HTTPException(
+                status_code=413,
+                detail="Image is too large to decode within the server memory budget; send a smaller image or a JPEG"
+            )
+        if reservation is not None:
+            await reservation.acquire(estimate)
+        
+        with pipeline_stage("decode", decode_pixels):
+            image = image.convert("RGB")
+            if image.size != (target_width, target_height):
+                # Resize large images to prevent memory issues and improve processing speed
+                image.thumbnail((target_width, target_height), Image.Resampling.LANCZOS)
+        
+        return image
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid image content or format: {str(e)}")
 
-def analyze_beach_characteristics(image: Image.Image) -> Dict:
-    """Analyze beach size, type, and natural characteristics using CLIP."""
+# CLIP image preprocessing parameters, read from the processor so the fast path stays in sync with it
+_image_processor = processor.image_processor
+CLIP_SHORTEST_EDGE = _image_processor.size["shortest_edge"]
+CLIP_CROP_SIZE = (_image_processor.crop_size["height"], _image_processor.crop_size["width"])
+CLIP_RESAMPLE = _image_processor.resample
+CLIP_RESCALE_FACTOR = _image_processor.rescale_factor
+CLIP_MEAN = np.array(_image_processor.image_mean, dtype=np.float32).reshape(3, 1, 1)
+CLIP_STD = np.array(_image_processor.image_std, dtype=np.float32).reshape(3, 1, 1)
+
+def preprocess_images(images: List[Image.Image], out: Optional[np.ndarray] = None) -> torch.Tensor:
+    """
+    Turn images (or tiles) into normalized CLIP pixel values in one pass, numerically matching the PIL-based
+    CLIPImageProcessor (not the torchvision "fast" one): shortest-edge resize, center crop, rescale and normalize,
+    written straight into a (N, 3, H, W) float32 buffer.
+    Pass `out` to reuse a buffer across calls; the returned tensor shares its memory.
+    """
+    crop_height, crop_width = CLIP_CROP_SIZE
+    if out is None or out.shape != (len(images), 3, crop_height, crop_width):
+        out = np.empty((len(images), 3, crop_height, crop_width), dtype=np.float32)
     
-    beach_characteristics_prompts = [
-        "a wide expansive sandy beach",
-        "a narrow beach strip with rocks",
-        "a small beach cove",
-        "a rocky coastline with pebbles",
-        "a sandy beach with fine, white sand",
-        "a beach with natural driftwood",
-        "a beach with natural seaweed and kelp",
-        "a beach with large natural rocks and stones",
-        "a beach with cliffs and natural formations",
-        "a beach with lush coastal vegetation and plants"
-    ]
-    
-    inputs = processor(
-        text=beach_characteristics_prompts,
-        images=image,
-        return_tensors="pt",
-        padding=True
-    )
+    for i, image in enumerate(images):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        
+        # Same output size rule as CLIPProcessor: shortest edge to CLIP_SHORTEST_EDGE, aspect ratio kept
+        width, height = image.size
+        short, long = (width, height) if width <= height else (height, width)
+        new_long = int(CLIP_SHORTEST_EDGE * long / short)
+        new_width, new_height = (CLIP_SHORTEST_EDGE, new_long) if width <= height else (new_long, CLIP_SHORTEST_EDGE)
+        # PIL's bicubic is kept (OpenCV's bicubic kernel differs) so results match the processor exactly
+        resized = np.asarray(image.resize((new_width, new_height), resample=CLIP_RESAMPLE, reducing_gap=None))
+        
+        top = (new_height - crop_height) // 2
+        left = (new_width - crop_width) // 2
+        crop = resized[top:top + crop_height, left:left + crop_width].transpose(2, 0, 1) # HWC -> CHW view
+        
+        # Rescale then normalize in place (float64 rescale cast to float32, as the processor does)
+        np.multiply(crop, CLIP_RESCALE_FACTOR, out=out[i], casting="same_kind")
+        np.subtract(out[i], CLIP_MEAN, out=out[i])
+        np.divide(out[i], CLIP_STD, out=out[i])
     
+    return torch.from_numpy(out)
+
+# Per-image results (embeddings), dropped automatically when the image (and so the request) goes away.
+# Images must not be modified in place after they have been preprocessed.
+_per_image_cache: Dict[Tuple[int, str], object] = {}
+
+def cached_for_image(image: Image.Image, name: str, compute):
+    """Compute `compute(image)` once per image and reuse it for the rest of the request."""
+    key = (id(image), name)
+    if key not in _per_image_cache:
+        _per_image_cache[key] = compute(image)
+        weakref.finalize(image, _per_image_cache.pop, key, None)
+    return _per_image_cache[key]
+
+# Pixel values are only needed for the vision forward pass (whose output is cached per image),
+# so a single input buffer is reused for every image
+_pixel_buffer = np.empty((1, 3, *CLIP_CROP_SIZE), dtype=np.float32)
+_pixel_buffer_lock = threading.Lock()
+
+class ImageEmbeddings(NamedTuple):
+    pooled: torch.Tensor # (D,) projected image embedding, as used for image-text logits
+    patches: torch.Tensor # (P, D) projected patch embeddings, as used for attention maps
+
+CLIP_EMBEDDING_DIM = model.config.projection_dim
+CLIP_NUM_PATCHES = (model.config.vision_config.image_size // model.config.vision_config.patch_size) ** 2
+
+def compute_image_embeddings(image: Image.Image) -> ImageEmbeddings:
+    """Run the CLIP vision tower once and keep both the pooled and the patch embeddings."""
+    with _pixel_buffer_lock:
+        with profile_region("clip_preprocess"):
+            pixel_values = preprocess_images([image], out=_pixel_buffer)
+        with torch.no_grad(), profile_region("clip:vision"):
+            # The vision model output contains both the pooled [CLS] output and the patch tokens
+            vision_output = model.vision_model(pixel_values)
+            pooled = model.visual_projection(vision_output.pooler_output)[0]
+            # Project patch embeddings to the same dimension as text features (768 -> 512 for CLIP-ViT-B/32)
+            patches = model.visual_projection(vision_output.last_hidden_state[:, 1:, :])[0] # Exclude [CLS] token
+    return ImageEmbeddings(pooled, patches)
+
+def image_embeddings(image: Image.Image) -> ImageEmbeddings:
+    """CLIP embeddings for an image, computed once per image."""
+    return cached_for_image(image, "embeddings", compute_image_embeddings)
+
+@lru_cache(maxsize=None)
+def text_features(prompts: Tuple[str, ...]) -> torch.Tensor:
+    """Projected CLIP text features for a fixed set of prompts, (T, D). Prompts never change, so they are encoded once."""
     with torch.no_grad():
-        outputs = model(**inputs)
-        probs = outputs.logits_per_image.softmax(dim=1)[0] # Probabilities for each prompt
-
-    # Determine beach size based on probabilities of relevant prompts
-    # Example: weight "wide expansive" higher, "narrow" medium, "small" lower
-    size_score = (probs[0] * 3 + probs[1] * 2 + probs[2] * 1).item()
-    
-    # Extract scores for natural elements
-    natural_elements = {
-        "driftwood": float(probs[5]),
-        "seaweed": float(probs[6]),
-        "rocks_stones": float(probs[7]),
-        "natural_formations": float(probs[8]),
-        "vegetation": float(probs[9])
-    }
+        tokens = processor.tokenizer(list(prompts), return_tensors="pt", padding=True)
+        return model.get_text_features(**tokens)
+
+def clip_logits(pooled: torch.Tensor, prompts: Tuple[str, ...]) -> torch.Tensor:
+    """Image-text logits for a batch of pooled embeddings (N, D) against prompts, (N, T); same as logits_per_image."""
+    with torch.no_grad():
+        image_embeds = pooled / pooled.norm(dim=-1, keepdim=True)
+        text_embeds = text_features(prompts)
+        text_embeds = text_embeds / text_embeds.norm(dim=-1, keepdim=True)
+        return model.logit_scale.exp() * image_embeds @ text_embeds.t()
+
+analysis_flights = SingleFlight()
+
+def image_content_key(content: bytes) -> str:
+    """Content hash used to coalesce identical images fetched from different URLs."""
+    return hashlib.sha256(content).hexdigest()
+
+BEACH_CHARACTERISTICS_PROMPTS = (
+    "a wide expansive sandy beach",
+    "a narrow beach strip with rocks",
+    "a small beach cove",
+    "a rocky coastline with pebbles",
+    "a sandy beach with fine, white sand",
+    "a beach with natural driftwood",
+    "a beach with natural seaweed and kelp",
+    "a beach with large natural rocks and stones",
+    "a beach with cliffs and natural formations",
+    "a beach with lush coastal vegetation and plants"
+)
+
+def beach_characteristics_from_embeddings(pooled: torch.Tensor) -> List[Dict]:
+    """Beach size, type, and natural characteristics for a batch of pooled image embeddings (N, D)."""
     
-    # Determine beach type
-    beach_type = "sandy" if probs[4] > probs[3] else "rocky" if probs[3] > probs[4] else "mixed"
+    all_probs = clip_logits(pooled, BEACH_CHARACTERISTICS_PROMPTS).softmax(dim=1) # Probabilities for each prompt
     
-    return {
-        "estimated_size": "large" if size_score > 2.5 else "medium" if size_score > 1.5 else "small",
-        "size_factor": float(size_score),
-        "natural_elements": natural_elements,
-        "beach_type": beach_type
-    }
+    results = []
+    for probs in all_probs:
+        # Determine beach size based on probabilities of relevant prompts
+        # Example: weight "wide expansive" higher, "narrow" medium, "small" lower
+        size_score = (probs[0] * 3 + probs[1] * 2 + probs[2] * 1).item()
+        
+        # Extract scores for natural elements
+        natural_elements = {
+            "driftwood": float(probs[5]),
+            "seaweed": float(probs[6]),
+            "rocks_stones": float(probs[7]),
+            "natural_formations": float(probs[8]),
+            "vegetation": float(probs[9])
+        }
+        
+        # Determine beach type
+        beach_type = "sandy" if probs[4] > probs[3] else "rocky" if probs[3] > probs[4] else "mixed"
+        
+        results.append({
+            "estimated_size": "large" if size_score > 2.5 else "medium" if size_score > 1.5 else "small",
+            "size_factor": float(size_score),
+            "natural_elements": natural_elements,
+            "beach_type": beach_type
+        })
+    return results
+
+def analyze_beach_characteristics(image: Image.Image) -> Dict:
+    """Analyze beach size, type, and natural characteristics using CLIP."""
+    return beach_characteristics_from_embeddings(image_embeddings(image).pooled[None])[0]
 
-def generate_attention_map(image: Image.Image, text_prompt: str) -> np.ndarray:
+def attention_grids_from_embeddings(patches: torch.Tensor, text_embedding: torch.Tensor) -> torch.Tensor:
     """
-    Generate an approximate spatial attention map using CLIP's patch embeddings.
+    Patch-level similarity to a text embedding (D,) for a batch of patch embeddings (N, P, D),
+    min-max normalized per image and shaped as (N, 1, grid, grid).
     This is a heuristic for localization as CLIP is not a direct object detection model.
     """
-    # Process image and text with CLIP processor
-    inputs = processor(text=[text_prompt], images=image, return_tensors="pt", padding=True)
-
     with torch.no_grad():
-        # Get the vision model output, specifically interested in the last hidden state for patches
-        # This requires accessing the internal structure of the CLIP model's vision transformer
-        # The output of vision_model usually contains `last_hidden_state` which includes patch embeddings
-        vision_output = model.vision_model(inputs['pixel_values'])
-        
-        # The last_hidden_state is typically (batch_size, sequence_length, hidden_size)
-        # sequence_length is (num_patches + 1) for [CLS] token + patches
-        patch_embeddings = vision_output.last_hidden_state[:, 1:, :] # Exclude [CLS] token (1, num_patches, 768)
-
-        # Get text features
-        text_features = model.get_text_features(inputs['input_ids']) # (1, 512)
-
-        # Project patch embeddings to the same dimension as text features (512 for CLIP-ViT-B/32)
-        # model.visual_projection is a nn.Linear(768, 512) for this model.
-        # It expects input of shape (..., in_features) and applies to the last dimension.
-        # So, (1, num_patches, 768) -> (1, num_patches, 512)
-        if model.visual_projection is not None:
-            projected_patch_embeddings = model.visual_projection(patch_embeddings)
-        else:
-            # Fallback if visual_projection is not directly accessible or applicable.
-            # This indicates a potential issue with the model loading or architecture.
-            raise RuntimeError("CLIP model does not have a visual_projection layer for patch embeddings. Cannot align dimensions for attention map.")
-            
-        # Now both `projected_patch_embeddings` (1, num_patches, 512) and `text_features` (1, 512)
-        # are in the same embedding space (512-dim).
+        text_embeds = text_embedding.reshape(1, -1) # (1, 512)
 
         # Calculate cosine similarity between each patch embedding and the text feature
-        # similarity_per_patch: (1, num_patches)
+        # similarity_per_patch: (N, num_patches)
         similarity_per_patch = torch.cosine_similarity(
-            projected_patch_embeddings, # (1, num_patches, 512)
-            text_features.unsqueeze(1), # (1, 1, 512) - unsqueeze for broadcasting
+            patches, # (N, num_patches, 512)
+            text_embeds.unsqueeze(1), # (1, 1, 512) - unsqueeze for broadcasting
             dim=-1 # Compare along the last dimension (embedding dimension)
         )
 
         # Normalize similarity scores to be between 0 and 1
-        similarity_per_patch = (similarity_per_patch - similarity_per_patch.min()) / (similarity_per_patch.max() - similarity_per_patch.min() + 1e-8)
+        low = similarity_per_patch.min(dim=1, keepdim=True).values
+        high = similarity_per_patch.max(dim=1, keepdim=True).values
+        similarity_per_patch = (similarity_per_patch - low) / (high - low + 1e-8)
 
         # Reshape to a grid (e.g., 7x7 for ViT-B/32, as 224/32 = 7)
-        grid_size = int(patch_embeddings.shape[1]**0.5)
-        if grid_size * grid_size != patch_embeddings.shape[1]:
+        num_images, num_patches = similarity_per_patch.shape
+        grid_size = int(num_patches**0.5)
+        if grid_size * grid_size != num_patches:
             # This fallback should ideally not be hit with standard CLIP image sizes
-            print(f"Warning: Patch count {patch_embeddings.shape[1]} is not a perfect square. Using a simpler attention map.")
+            print(f"Warning: Patch count {num_patches} is not a perfect square. Using a simpler attention map.")
             # If not a perfect square, we can't reshape to 2D grid directly.
             # A simple fallback is to just return a 1D map that will be interpolated.
             # This might result in less precise bounding boxes.
-            attention_map_grid = similarity_per_patch.view(1, 1, -1, 1) # Reshape to (N, C, H, W) where W=1
-        else:
-            attention_map_grid = similarity_per_patch.view(1, 1, grid_size, grid_size) # (1, 1, 7, 7) for 224x224 input
+            return similarity_per_patch.view(num_images, 1, -1, 1) # Reshape to (N, C, H, W) where W=1
+        return similarity_per_patch.view(num_images, 1, grid_size, grid_size) # (N, 1, 7, 7) for 224x224 input
 
-        # Interpolate to original image size
-        attention_map = torch.nn.functional.interpolate(
-            attention_map_grid,
-            size=(image.height, image.width),
+def upsample_attention_map(attention_grid: torch.Tensor, height: int, width: int) -> np.ndarray:
+    """Interpolate one (1, H, W) attention grid to the original image size."""
+    with torch.no_grad():
+        return torch.nn.functional.interpolate(
+            attention_grid[None],
+            size=(height, width),
             mode='bilinear',
             align_corners=False
         ).squeeze().detach().numpy()
-    
-    return attention_map
 
 
 def non_max_suppression(boxes: List[Tuple[int, int, int, int]], scores: List[float], iou_threshold: float = 0.5) -> List[Tuple[int, int, int, int]]:
@@ -330,156 +733,209 @@ def find_object_regions(attention_map: np.ndarray, threshold: float = 0.3, min_s
     return final_boxes
 
 
-def detect_trash_objects_with_location(image: Image.Image) -> List[Dict]:
-    """Detect and classify trash objects with bounding box locations using CLIP and NMS."""
-    
-    # Detailed trash classification with severity levels and colors
-    trash_categories = {
-        "plastic_bottles": {
-            "prompts": ["plastic water bottles", "discarded plastic soda bottles", "empty plastic containers"],
-            "severity": 6,
-            "description": "Plastic bottles",
-            "color": "#FF4444"  # Red
-        },
-        "plastic_bags": {
-            "prompts": ["plastic shopping bags", "plastic debris bags", "film plastic"],
-            "severity": 7,
-            "description": "Plastic bags",
-            "color": "#FF6B6B"  # Light red
-        },
-        "cigarette_butts": {
-            "prompts": ["cigarette butts", "tobacco waste", "filter tips"],
-            "severity": 4,
-            "description": "Cigarette butts",
-            "color": "#FFA500"  # Orange
-        },
-        "food_containers": {
-            "prompts": ["takeaway food containers", "disposable food packaging", "styrofoam boxes"],
-            "severity": 5,
-            "description": "Food containers and packaging",
-            "color": "#FFD700"  # Gold
-        },
-        "cans_bottles": {
-            "prompts": ["aluminum cans", "glass bottles", "beverage containers"],
-            "severity": 5,
-            "description": "Cans and glass bottles",
-            "color": "#32CD32"  # Lime green
-        },
-        "fishing_debris": {
-            "prompts": ["fishing nets", "fishing lines", "fishing gear", "buoys"],
-            "severity": 8,
-            "description": "Fishing equipment and nets",
-            "color": "#8A2BE2"  # Blue violet
-        },
-        "large_debris": {
-            "prompts": ["large pieces of trash", "furniture", "appliances", "construction waste"],
-            "severity": 9,
-            "description": "Large debris items",
-            "color": "#DC143C"  # Crimson
-        },
-        "microplastics": {
-            "prompts": ["small plastic fragments", "tiny plastic pieces", "microscopic plastic"],
-            "severity": 6,
-            "description": "Microplastics and fragments",
-            "color": "#FF69B4"  # Hot pink
-        },
-        "paper_cardboard": {
-            "prompts": ["paper litter", "cardboard boxes", "newspaper"],
-            "severity": 3,
-            "description": "Paper and cardboard waste",
-            "color": "#87CEEB"  # Sky blue
-        },
-        "chemical_containers": {
-            "prompts": ["chemical containers", "hazardous waste drums", "oil spills"],
-            "severity": 10,
-            "description": "Chemical or hazardous containers",
-            "color": "#B22222"  # Fire brick
-        },
-        "footwear": {
-            "prompts": ["discarded shoes", "flip-flops", "sandals"],
-            "severity": 4,
-            "description": "Footwear",
-            "color": "#A0522D" # Sienna
-        },
-        "clothing": {
-            "prompts": ["discarded clothes", "textile waste", "rags"],
-            "severity": 5,
-            "description": "Clothing and textiles",
-            "color": "#4682B4" # Steel Blue
-        }
+# Detailed trash classification with severity levels and colors
+TRASH_CATEGORIES = {
+    "plastic_bottles": {
+        "prompts": ["plastic water bottles", "discarded plastic soda bottles", "empty plastic containers"],
+        "severity": 6,
+        "description": "Plastic bottles",
+        "color": "#FF4444"  # Red
+    },
+    "plastic_bags": {
+        "prompts": ["plastic shopping bags", "plastic debris bags", "film plastic"],
+        "severity": 7,
+        "description": "Plastic bags",
+        "color": "#FF6B6B"  # Light red
+    },
+    "cigarette_butts": {
+        "prompts": ["cigarette butts", "tobacco waste", "filter tips"],
+        "severity": 4,
+        "description": "Cigarette butts",
+        "color": "#FFA500"  # Orange
+    },
+    "food_containers": {
+        "prompts": ["takeaway food containers", "disposable food packaging", "styrofoam boxes"],
+        "severity": 5,
+        "description": "Food containers and packaging",
+        "color": "#FFD700"  # Gold
+    },
+    "cans_bottles": {
+        "prompts": ["aluminum cans", "glass bottles", "beverage containers"],
+        "severity": 5,
+        "description": "Cans and glass bottles",
+        "color": "#32CD32"  # Lime green
+    },
+    "fishing_debris": {
+        "prompts": ["fishing nets", "fishing lines", "fishing gear", "buoys"],
+        "severity": 8,
+        "description": "Fishing equipment and nets",
+        "color": "#8A2BE2"  # Blue violet
+    },
+    "large_debris": {
+        "prompts": ["large pieces of trash", "furniture", "appliances", "construction waste"],
+        "severity": 9,
+        "description": "Large debris items",
+        "color": "#DC143C"  # Crimson
+    },
+    "microplastics": {
+        "prompts": ["small plastic fragments", "tiny plastic pieces", "microscopic plastic"],
+        "severity": 6,
+        "description": "Microplastics and fragments",
+        "color": "#FF69B4"  # Hot pink
+    },
+    "paper_cardboard": {
+        "prompts": ["paper litter", "cardboard boxes", "newspaper"],
+        "severity": 3,
+        "description": "Paper and cardboard waste",
+        "color": "#87CEEB"  # Sky blue
+    },
+    "chemical_containers": {
+        "prompts": ["chemical containers", "hazardous waste drums", "oil spills"],
+        "severity": 10,
+        "description": "Chemical or hazardous containers",
+        "color": "#B22222"  # Fire brick
+    },
+    "footwear": {
+        "prompts": ["discarded shoes", "flip-flops", "sandals"],
+        "severity": 4,
+        "description": "Footwear",
+        "color": "#A0522D" # Sienna
+    },
+    "clothing": {
+        "prompts": ["discarded clothes", "textile waste", "rags"],
+        "severity": 5,
+        "description": "Clothing and textiles",
+        "color": "#4682B4" # Steel Blue
     }
+}
+
+def detection_threshold(severity: int) -> float:
+    """
+    Dynamic thresholding on image-text cosine similarity: higher severity items need a lower
+    similarity to be detected. This helps in detecting critical items even if less prominent.
+    """
+    base_threshold = 0.26 # Default threshold; CLIP ViT-B/32 similarities for matching prompts sit around 0.25-0.35
+    severity_adjustment = (severity - 5) * 0.005 # Adjust by severity
+    return base_threshold - severity_adjustment # 0.235 (severity 10) to 0.28 (severity 1)
+
+def load_category_thresholds(path: str) -> Dict[str, float]:
+    """
+    Per-category detection thresholds on cosine similarity (see category_similarities). Calibrated values
+    can be supplied as a JSON object {category: threshold} (see rescore.py --calibrate-rate);
+    other categories use the severity-based default.
+    """
+    thresholds = {category: detection_threshold(details["severity"]) for category, details in TRASH_CATEGORIES.items()}
+    if path:
+        with open(path) as f:
+            calibrated = json.load(f)
+        thresholds.update({category: float(value) for category, value in calibrated.items() if category in thresholds})
+    return thresholds
+
+CATEGORY_THRESHOLDS = load_category_thresholds(CATEGORY_THRESHOLDS_PATH)
+
+@lru_cache(maxsize=None)
+def category_ensemble_embeddings() -> torch.Tensor:
+    """
+    One class embedding per trash category, (C, D) in TRASH_CATEGORIES order:
+    the mean of the category's normalized prompt embeddings, renormalized.
+    """
+    with torch.no_grad():
+        ensembles = []
+        for details in TRASH_CATEGORIES.values():
+            prompt_embeds = text_features(tuple(details["prompts"]))
+            prompt_embeds = prompt_embeds / prompt_embeds.norm(dim=-1, keepdim=True)
+            ensemble = prompt_embeds.mean(dim=0)
+            ensembles.append(ensemble / ensemble.norm())
+        return torch.stack(ensembles)
+
+def category_similarities(pooled: torch.Tensor) -> torch.Tensor:
+    """Cosine similarity of a batch of pooled image embeddings to every trash category, (N, C), in one step."""
+    with torch.no_grad():
+        image_embeds = pooled / pooled.norm(dim=-1, keepdim=True)
+        return image_embeds @ category_ensemble_embeddings().t()
+
+def category_confidences(similarities: torch.Tensor, thresholds: torch.Tensor) -> torch.Tensor:
+    """
+    Detection confidence from each similarity's margin over its category threshold, on CLIP's logit scale:
+    0.5 at the threshold, ~0.73 at +0.01 and ~0.99 at +0.05. Scoring weights severity and penalties by it,
+    so borderline hits count for less than strong ones (sigmoid of the raw logits is ~1 for any match).
+    """
+    with torch.no_grad():
+        return torch.sigmoid(model.logit_scale.exp() * (similarities - thresholds))
+
+def detect_trash_objects_from_embeddings(
+    pooled: torch.Tensor,
+    patches: torch.Tensor,
+    sizes: List[Tuple[int, int]]
+) -> List[List[Dict]]:
+    """
+    Detect and classify trash objects with bounding box locations for a batch of images,
+    given pooled (N, D) and patch (N, P, D) embeddings and each image's (width, height).
+    Every category is scored against every image at once using its prompt-ensemble embedding.
+    """
+    categories = list(TRASH_CATEGORIES.items())
+    thresholds = torch.tensor([CATEGORY_THRESHOLDS[category] for category, _ in categories])
+    with profile_region("clip:categories"):
+        similarities = category_similarities(pooled) # (N, C)
+        confidences = category_confidences(similarities, thresholds)
+    over_threshold = similarities > thresholds
     
-    detected_objects = []
+    detected_objects = [[] for _ in sizes]
     
-    for category, details in trash_categories.items():
-        # Test each prompt for this category
-        for prompt in details["prompts"]:
-            inputs = processor(
-                text=[prompt],
-                images=[image],
-                return_tensors="pt",
-                padding=True
-            )
+    for i, (width, height) in enumerate(sizes):
+        for category_index in over_threshold[i].nonzero().flatten().tolist():
+            category, details = categories[category_index]
+            confidence = confidences[i, category_index].item()
             
-            with torch.no_grad():
-                outputs = model(**inputs)
-                similarity = outputs.logits_per_image[0][0]
-                confidence = torch.sigmoid(similarity).item() # Convert logit to probability
-
-                # Dynamic thresholding: higher severity items need lower confidence to be detected
-                # This helps in detecting critical items even if less prominent.
-                base_threshold = 0.15 # Default threshold
-                severity_adjustment = (details["severity"] - 5) * 0.01 # Adjust by severity
-                effective_threshold = max(0.05, base_threshold - severity_adjustment) # Min threshold of 0.05
-                
-                if confidence > effective_threshold:
-                    try:
-                        attention_map = generate_attention_map(image, prompt)
-                        # Pass iou_threshold to find_object_regions
-                        bounding_boxes = find_object_regions(attention_map, threshold=0.45, min_size=30, iou_threshold=0.5) # Increased min_size
-                        
-                        if bounding_boxes:
-                            for bbox in bounding_boxes:
-                                x, y, w, h = bbox
-                                detected_objects.append({
-                                    "category": category,
-                                    "confidence": confidence,
-                                    "severity": details["severity"],
-                                    "description": details["description"],
-                                    "color": details["color"],
-                                    "bounding_box": {
-                                        "x": int(x),
-                                        "y": int(y),
-                                        "width": int(w),
-                                        "height": int(h)
-                                    }
-                                })
-                        else:
-                            # If no specific region found but object detected, add without bounding box
-                            detected_objects.append({
-                                "category": category,
-                                "confidence": confidence,
-                                "severity": details["severity"],
-                                "description": details["description"],
-                                "color": details["color"],
-                                "bounding_box": None
-                            })
-                    except Exception as e:
-                        print(f"Error generating attention map or bounding boxes for {prompt}: {e}")
-                        # Fallback: object detected but no localization
-                        detected_objects.append({
-                            "category": category,
-                            "confidence": confidence,
-                            "severity": details["severity"],
-                            "description": details["description"],
-                            "color": details["color"],
-                            "bounding_box": None
-                        })
-                        
-                    break  # Found object in this category, no need to test other prompts
+            try:
+                with profile_region("attention_map"):
+                    attention_grid = attention_grids_from_embeddings(
+                        patches[i:i + 1], category_ensemble_embeddings()[category_index]
+                    )[0]
+                    attention_map = upsample_attention_map(attention_grid, height, width)
+                # Pass iou_threshold to find_object_regions
+                with profile_region("find_object_regions"):
+                    bounding_boxes = find_object_regions(attention_map, threshold=0.45, min_size=30, iou_threshold=0.5) # Increased min_size
+            except Exception as e:
+                print(f"Error generating attention map or bounding boxes for {category}: {e}")
+                bounding_boxes = [] # Fallback: object detected but no localization
+            
+            if bounding_boxes:
+                for bbox in bounding_boxes:
+                    x, y, w, h = bbox
+                    detected_objects[i].append({
+                        "category": category,
+                        "confidence": confidence,
+                        "severity": details["severity"],
+                        "description": details["description"],
+                        "color": details["color"],
+                        "bounding_box": {
+                            "x": int(x),
+                            "y": int(y),
+                            "width": int(w),
+                            "height": int(h)
+                        }
+                    })
+            else:
+                # If no specific region found but object detected, add without bounding box
+                detected_objects[i].append({
+                    "category": category,
+                    "confidence": confidence,
+                    "severity": details["severity"],
+                    "description": details["description"],
+                    "color": details["color"],
+                    "bounding_box": None
+                })
     
     return detected_objects
 
+def detect_trash_objects_with_location(image: Image.Image) -> List[Dict]:
+    """Detect and classify trash objects with bounding box locations using CLIP and NMS."""
+    embeddings = image_embeddings(image)
+    return detect_trash_objects_from_embeddings(
+        embeddings.pooled[None], embeddings.patches[None], [(image.width, image.height)]
+    )[0]
+
 def annotate_image_with_detections(image: Image.Image, detected_objects: List[Dict]) -> Image.Image:
     """Annotate image with bounding boxes and labels for detected objects."""
     
@@ -563,42 +1019,51 @@ def image_to_base64(image: Image.Image) -> str:
     img_str = base64.b64encode(buffer.getvalue()).decode()
     return img_str
 
+NATURAL_VS_ARTIFICIAL_PROMPTS = (
+    "natural driftwood logs on beach",
+    "natural seaweed and kelp",
+    "natural rocks and pebbles",
+    "natural shells and coral",
+    "construction debris and concrete waste",
+    "artificial plastic litter",
+    "metal and industrial waste",
+    "processed wood and lumber scraps",
+    "clean beach with natural elements",
+    "polluted beach with artificial trash"
+)
+
+def natural_artificial_from_embeddings(pooled: torch.Tensor) -> List[Dict]:
+    """Natural vs artificial scores for a batch of pooled image embeddings (N, D)."""
+    
+    all_probs = clip_logits(pooled, NATURAL_VS_ARTIFICIAL_PROMPTS).softmax(dim=1)
+    
+    results = []
+    for probs in all_probs:
+        # Sum probabilities for natural and artificial categories
+        natural_score = float(sum(probs[i] for i in [0, 1, 2, 3, 8])) # driftwood, seaweed, rocks, shells, clean beach
+        artificial_score = float(sum(probs[i] for i in [4, 5, 6, 7, 9])) # construction, plastic, metal, wood, polluted beach
+        
+        # Pairwise "clean beach" vs "polluted beach" confidence, used by the early-exit cascade
+        clean_confidence = float(probs[8] / (probs[8] + probs[9] + 1e-8))
+        
+        results.append({
+            "natural_score": natural_score,
+            "artificial_score": artificial_score,
+            "natural_ratio": natural_score / (natural_score + artificial_score + 1e-8), # Add epsilon to prevent division by zero
+            "clean_confidence": clean_confidence
+        })
+    return results
+
 def distinguish_natural_vs_artificial(image: Image.Image) -> Dict:
     """Distinguish between natural beach elements and artificial debris using CLIP."""
-    
-    natural_vs_artificial_prompts = [
-        "natural driftwood logs on beach",
-        "natural seaweed and kelp",
-        "natural rocks and pebbles",
-        "natural shells and coral",
-        "construction debris and concrete waste",
-        "artificial plastic litter",
-        "metal and industrial waste",
-        "processed wood and lumber scraps",
-        "clean beach with natural elements",
-        "polluted beach with artificial trash"
-    ]
-    
-    inputs = processor(
-        text=natural_vs_artificial_prompts,
-        images=image,
-        return_tensors="pt",
-        padding=True
+    return natural_artificial_from_embeddings(image_embeddings(image).pooled[None])[0]
+
+def is_clearly_clean(natural_artificial: Dict) -> bool:
+    """Decide whether the global clean/polluted similarity is confident enough to skip localization."""
+    return (
+        natural_artificial["clean_confidence"] >= EARLY_EXIT_CLEAN_CONFIDENCE and
+        natural_artificial["natural_ratio"] >= EARLY_EXIT_MIN_NATURAL_RATIO
     )
-    
-    with torch.no_grad():
-        outputs = model(**inputs)
-        probs = outputs.logits_per_image.softmax(dim=1)[0]
-    
-    # Sum probabilities for natural and artificial categories
-    natural_score = float(sum(probs[i] for i in [0, 1, 2, 3, 8])) # driftwood, seaweed, rocks, shells, clean beach
-    artificial_score = float(sum(probs[i] for i in [4, 5, 6, 7, 9])) # construction, plastic, metal, wood, polluted beach
-    
-    return {
-        "natural_score": natural_score,
-        "artificial_score": artificial_score,
-        "natural_ratio": natural_score / (natural_score + artificial_score + 1e-8) # Add epsilon to prevent division by zero
-    }
 
 def calculate_advanced_cleanliness_score(
     detected_objects: List[Dict],
@@ -614,6 +1079,9 @@ def calculate_advanced_cleanliness_score(
     size_penalty_multiplier = size_factors.get(beach_characteristics["estimated_size"], 1.0)
     
     total_impact_penalty = 0
+    total_weighted_severity = 0
+    density_penalty = 0
+    severity_penalty = 0
     object_count = len(detected_objects)
     
     if object_count > 0:
@@ -675,6 +1143,60 @@ def categorize_cleanliness(score: float) -> str:
     else:
         return "Heavily Polluted"
 
+llm_breaker = CircuitBreaker(LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_COOLDOWN)
+llm_stats = {"llm": 0, "fallback": 0}
+
+def generate_local_recommendations(
+    cleanliness_score: float,
+    category: str,
+    detected_objects: List[Dict],
+    beach_characteristics: Dict
+) -> str:
+    """
+    Deterministic, rule-based recommendations built from the detected categories and severities.
+    Used whenever Gemini is unavailable, slow or unhealthy.
+    """
+    # Keep the most severe detection per category, most severe first
+    by_category = {}
+    for obj in detected_objects:
+        if obj["category"] not in by_category or obj["confidence"] > by_category[obj["category"]]["confidence"]:
+            by_category[obj["category"]] = obj
+    ranked = sorted(by_category.values(), key=lambda obj: (-obj["severity"], obj["category"]))
+
+    category_actions = {
+        "chemical_containers": "Cordon off the area and report the hazardous containers to the local environmental authority for professional removal; volunteers should not handle them.",
+        "large_debris": "Arrange equipment and a vehicle for removal of large debris items, and notify the municipality about possible illegal dumping.",
+        "fishing_debris": "Remove nets, lines and other fishing gear promptly to prevent wildlife entanglement, and work with local fishers on gear disposal and recovery points.",
+        "plastic_bags": "Prioritise collecting plastic bags and film before they are carried back into the water, and promote reusable-bag campaigns with nearby vendors.",
+        "plastic_bottles": "Collect plastic bottles for recycling and set up bottle-return or refill stations near beach entrances.",
+        "microplastics": "Run a sieving cleanup along the high-tide line to recover small plastic fragments, and log samples for monitoring.",
+        "food_containers": "Work with nearby food vendors to reduce disposable packaging and place covered bins close to eating areas.",
+        "cans_bottles": "Collect cans and glass separately for recycling, taking care with broken glass.",
+        "clothing": "Collect discarded clothing and textiles for donation or textile recycling.",
+        "footwear": "Gather discarded footwear and flip-flops, which fragment into microplastics if left on the sand.",
+        "cigarette_butts": "Install cigarette butt receptacles and signage, and consider a smoke-free beach policy.",
+        "paper_cardboard": "Clear paper and cardboard litter and add recycling bins at access points."
+    }
+
+    recommendations = [category_actions[obj["category"]] for obj in ranked[:3] if obj["category"] in category_actions]
+
+    if cleanliness_score < 40:
+        recommendations.append("Organise a large-scale volunteer cleanup event soon, with separate bags for recyclables and hazardous items.")
+    elif cleanliness_score < 70:
+        recommendations.append("Schedule a targeted cleanup focused on the areas where debris was detected.")
+    else:
+        recommendations.append("Maintain the current condition with regular monitoring and small periodic cleanups.")
+
+    if beach_characteristics.get("estimated_size") == "large" and cleanliness_score < 70:
+        recommendations.append("Divide the beach into zones and assign volunteer teams to each to cover the large area efficiently.")
+    natural_present = [k for k, v in beach_characteristics.get("natural_elements", {}).items() if v > 0.5]
+    if natural_present:
+        recommendations.append(f"Leave natural elements ({', '.join(natural_present)}) in place during cleanups, as they support the coastal ecosystem.")
+    if len(recommendations) < 3:
+        recommendations.append("Re-survey the beach after the next cleanup to track changes in the cleanliness score.")
+
+    return "\n".join(f"* {item}" for item in recommendations[:5])
+
 async def get_recommendations_from_llm(
     cleanliness_score: float,
     category: str,
@@ -684,7 +1206,13 @@ async def get_recommendations_from_llm(
 ) -> str:
     """
     Generates detailed, actionable recommendations using the Gemini API.
+    Falls back to local rule-based recommendations when the API key is missing, the call
+    fails or exceeds its deadline, or the circuit breaker is open.
     """
+    def fallback() -> str:
+        llm_stats["fallback"] += 1
+        return generate_local_recommendations(cleanliness_score, category, detected_objects, beach_characteristics)
+
     object_summaries = ", ".join([f"{obj['description']} (Severity: {obj['severity']}/10)" for obj in detected_objects])
     if not object_summaries:
         object_summaries = "No significant artificial debris detected."
@@ -708,90 +1236,418 @@ async def get_recommendations_from_llm(
     # Retrieve API key from environment variable
     apiKey = os.environ.get("GEMINI_API_KEY", "") 
     if not apiKey:
-        print("Warning: GEMINI_API_KEY environment variable not set. LLM recommendations will not work.")
-        return "Failed to generate recommendations: API key is missing."
+        print("Warning: GEMINI_API_KEY environment variable not set. Using local recommendations.")
+        return fallback()
+
+    apiUrl = f"{GEMINI_API_BASE_URL}/v1beta/models/gemini-2.0-flash:generateContent?key={apiKey}"
 
-    apiUrl = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={apiKey}"
+    # Fail fast while the upstream is unhealthy
+    allowed, probe = llm_breaker.allow_request()
+    if not allowed:
+        return fallback()
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(apiUrl, headers={'Content-Type': 'application/json'}, data=json.dumps(payload)) as response:
-                response.raise_for_status() # Raise an exception for HTTP errors
-                result = await response.json()
-                
-                if result.get("candidates") and len(result["candidates"]) > 0 and \
-                   result["candidates"][0].get("content") and \
-                   result["candidates"][0]["content"].get("parts") and \
-                   len(result["candidates"][0]["content"]["parts"]) > 0:
-                    return result["candidates"][0]["content"]["parts"][0]["text"]
-                else:
-                    print("LLM response structure unexpected:", result)
-                    return "No specific recommendations could be generated by AI."
-    except aiohttp.ClientError as e:
+        text = await call_gemini(
+            apiUrl, payload, time.monotonic() + LLM_TOTAL_DEADLINE,
+            LLM_ATTEMPT_TIMEOUT, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY
+        )
+    except asyncio.CancelledError:
+        # A cancelled call (e.g. the client disconnected) says nothing about the upstream;
+        # just free the probe slot so the breaker isn't left waiting on an abandoned probe
+        if probe:
+            llm_breaker.release_probe()
+        raise
+    except (RetryableLLMError, aiohttp.ClientError) as e:
         print(f"LLM API call failed: {e}")
-        return "Failed to generate recommendations due to API error."
+        llm_breaker.record_failure()
+        return fallback()
     except Exception as e:
         print(f"An unexpected error occurred during LLM call: {e}")
-        return "An error occurred while generating recommendations."
+        llm_breaker.record_failure()
+        return fallback()
 
-@app.post("/analyze", response_model=AnalysisResponse)
-async def analyze_beach_cleanliness(payload: AnalyzeRequest):
+    llm_breaker.record_success()
+    llm_stats["llm"] += 1
+    return text
+
+def format_detection(obj: Dict) -> Dict:
+    """Public view of an internal detection (drops the annotation colour, rounds confidence)."""
+    return {
+        "category": obj["category"],
+        "confidence": round(obj["confidence"], 3),
+        "severity": obj["severity"],
+        "description": obj["description"],
+        "bounding_box": obj["bounding_box"]
+    }
+
+class EmbeddingStore:
     """
-    Advanced beach cleanliness analysis with detailed object detection.
-    Returns comprehensive analysis with accurate scoring and AI-generated recommendations.
+    Append-only, memory-mappable on-disk store of CLIP image embeddings, one row per analyzed image:
+    pooled.f16 (N, D) and patches.f16 (N, P, D) in float16, plus one JSON metadata line per row in index.jsonl.
+    The index line is written last, so a row without one (e.g. after a crash) is discarded when the store is opened,
+    as is a partially written last index line.
+
+    Only the writing process repairs the files. With read_only=True (offline readers such as rescore.py, which may run
+    while the service is appending) nothing is modified: rows past the index and a trailing partial line are ignored.
     """
-    try:
-        # Download and validate image
-        image = await download_image(payload.image_url)
+    def __init__(self, directory: str, dim: int, num_patches: int, read_only: bool = False):
+        self.directory = directory
+        self.dim = dim
+        self.num_patches = num_patches
+        self.read_only = read_only
+        self.pooled_path = os.path.join(directory, "pooled.f16")
+        self.patches_path = os.path.join(directory, "patches.f16")
+        self.index_path = os.path.join(directory, "index.jsonl")
+        self._lock = threading.Lock()
+        self.index: List[Dict] = []
         
-        # Analyze beach characteristics
-        beach_characteristics = analyze_beach_characteristics(image)
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.index_path):
+            self.index = self._read_index()
         
-        # Detect trash objects with locations
-        detected_objects = detect_trash_objects_with_location(image)
+        row_sizes = ((self.pooled_path, dim * 2), (self.patches_path, num_patches * dim * 2))
+        if read_only:
+            # A writer may be between writing a row and its index line; only use rows present in every file
+            rows = min([os.path.getsize(path) // row_bytes if os.path.exists(path) else 0 for path, row_bytes in row_sizes])
+            del self.index[rows:]
+        else:
+            # Drop any partially written rows beyond the index
+            for path, row_bytes in row_sizes:
+                if os.path.exists(path) and os.path.getsize(path) > len(self.index) * row_bytes:
+                    os.truncate(path, len(self.index) * row_bytes)
+        self._ids = {entry["id"] for entry in self.index}
+
+    def _read_index(self) -> List[Dict]:
+        """
+        Read index.jsonl. A crash while appending can leave a partial last line (unterminated or
+        not valid JSON); it is truncated away so the store still opens and later appends start cleanly
+        (read-only stores just skip it).
+        """
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        valid_bytes = data.rfind(b"\n") + 1 # Anything after the last newline is an unfinished line
+        lines = data[:valid_bytes].split(b"\n")[:-1]
+        index = []
+        for i, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                index.append(json.loads(line))
+            except ValueError:
+                if i != len(lines) - 1:
+                    raise ValueError(f"Corrupt embedding index {self.index_path} at line {i + 1}")
+                valid_bytes -= len(line) + 1
+        if valid_bytes < len(data) and not self.read_only:
+            print(f"Warning: discarding partially written last line of {self.index_path}")
+            os.truncate(self.index_path, valid_bytes)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _write_row(self, path: str, row: np.ndarray):
+        """Write a row at the offset the index says it belongs at, overwriting any leftover bytes."""
+        offset = len(self.index) * row.nbytes
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(offset)
+            f.write(row.tobytes())
+            f.truncate()
+
+    def append(self, image_id: str, embeddings: ImageEmbeddings, metadata: Dict) -> bool:
+        """
+        Store an image's embeddings; returns False if that image is already stored.
+        On failure every file is rolled back to its previous length, so rows stay aligned with the index.
+        """
+        if self.read_only:
+            raise RuntimeError(f"Embedding store {self.directory} was opened read-only")
+        pooled = embeddings.pooled.detach().numpy().astype(np.float16)
+        patches = embeddings.patches.detach().numpy().astype(np.float16)
+        entry = {"id": image_id, **metadata}
+        with self._lock:
+            if image_id in self._ids:
+                return False
+            index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+            try:
+                self._write_row(self.pooled_path, pooled)
+                self._write_row(self.patches_path, patches)
+                with open(self.index_path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except BaseException:
+                for path, size in (
+                    (self.pooled_path, len(self.index) * pooled.nbytes),
+                    (self.patches_path, len(self.index) * patches.nbytes),
+                    (self.index_path, index_size)
+                ):
+                    try:
+                        if os.path.exists(path):
+                            os.truncate(path, size)
+                    except OSError:
+                        pass # The offset-based writes above still keep later rows aligned
+                raise
+            self.index.append(entry)
+            self._ids.add(image_id)
+        return True
+
+    def load(self) -> Tuple[List[Dict], np.ndarray, np.ndarray]:
+        """Index entries with read-only memory maps of the pooled (N, D) and patch (N, P, D) embeddings."""
+        with self._lock:
+            index = list(self.index)
+        if not index:
+            return [], np.empty((0, self.dim), np.float16), np.empty((0, self.num_patches, self.dim), np.float16)
+        pooled = np.memmap(self.pooled_path, dtype=np.float16, mode="r", shape=(len(index), self.dim))
+        patches = np.memmap(self.patches_path, dtype=np.float16, mode="r", shape=(len(index), self.num_patches, self.dim))
+        return index, pooled, patches
+
+_embedding_store: Optional[EmbeddingStore] = None
+_embedding_store_disabled = False
+
+def get_embedding_store() -> Optional[EmbeddingStore]:
+    """
+    The service's embedding store, opened on first use (None when EMBEDDING_STORE_DIR is empty).
+    Storing embeddings is best-effort: if the store cannot be opened, that is logged once and
+    the store stays disabled for the rest of the process.
+    """
+    global _embedding_store, _embedding_store_disabled
+    if _embedding_store is None and EMBEDDING_STORE_DIR and not _embedding_store_disabled:
+        try:
+            _embedding_store = EmbeddingStore(EMBEDDING_STORE_DIR, CLIP_EMBEDDING_DIM, CLIP_NUM_PATCHES)
+        except Exception as e:
+            _embedding_store_disabled = True
+            print(f"Embedding store disabled: could not open {EMBEDDING_STORE_DIR}: {e}")
+    return _embedding_store
+
+def rescore_stored_embeddings(
+    store: EmbeddingStore,
+    batch_size: int = 1024,
+    allow_early_exit: bool = True
+) -> Iterator[Dict]:
+    """
+    Rebuild characteristics, detections and scores for every stored image from its embeddings alone,
+    with the current prompts, thresholds and scoring. Images are processed in vectorized batches.
+    """
+    index, pooled_all, patches_all = store.load()
+    for start in range(0, len(index), batch_size):
+        entries = index[start:start + batch_size]
+        pooled = torch.from_numpy(np.asarray(pooled_all[start:start + batch_size], dtype=np.float32))
+        patches = torch.from_numpy(np.asarray(patches_all[start:start + batch_size], dtype=np.float32))
+        
+        characteristics = beach_characteristics_from_embeddings(pooled)
+        natural_artificial = natural_artificial_from_embeddings(pooled)
+        
+        # Same early-exit decision as live requests; only the remaining images need localization
+        early_exit = [EARLY_EXIT_ENABLED and allow_early_exit and is_clearly_clean(na) for na in natural_artificial]
+        to_detect = [i for i, exited in enumerate(early_exit) if not exited]
+        detected = [[] for _ in entries]
+        if to_detect:
+            batch_detections = detect_trash_objects_from_embeddings(
+                pooled[to_detect], patches[to_detect], [(entries[i]["width"], entries[i]["height"]) for i in to_detect]
+            )
+            for i, objects in zip(to_detect, batch_detections):
+                detected[i] = objects
+        
+        for i, entry in enumerate(entries):
+            score, detailed_analysis = calculate_advanced_cleanliness_score(detected[i], characteristics[i], natural_artificial[i])
+            detailed_analysis["early_exit"] = early_exit[i]
+            detailed_analysis["clean_confidence"] = natural_artificial[i]["clean_confidence"]
+            yield {
+                "id": entry["id"],
+                "image_url": entry.get("image_url"),
+                "analyzed_at": entry.get("analyzed_at"),
+                "previous_cleanliness_score": entry.get("cleanliness_score"),
+                "cleanliness_score": round(score, 2),
+                "category": categorize_cleanliness(score),
+                "detected_objects": [format_detection(obj) for obj in detected[i]],
+                "beach_characteristics": characteristics[i],
+                "detailed_analysis": detailed_analysis
+            }
+
+def calibrate_category_thresholds(store: EmbeddingStore, target_rate: float, batch_size: int = 4096) -> Dict[str, float]:
+    """
+    Unsupervised calibration: per category, the similarity threshold at which that category
+    would fire on `target_rate` of the stored images.
+    """
+    _, pooled_all, _ = store.load()
+    if len(pooled_all) == 0:
+        raise ValueError("Embedding store is empty; nothing to calibrate from")
+    similarities = torch.cat([
+        category_similarities(torch.from_numpy(np.asarray(pooled_all[start:start + batch_size], dtype=np.float32)))
+        for start in range(0, len(pooled_all), batch_size)
+    ])
+    quantiles = torch.quantile(similarities.double(), 1 - target_rate, dim=0)
+    return {category: float(q) for category, q in zip(TRASH_CATEGORIES, quantiles)}
+
+async def analysis_stages(content: bytes, payload: AnalyzeRequest) -> AsyncIterator[Tuple[str, Dict]]:
+    """
+    Run the full analysis pipeline on downloaded image bytes, yielding (stage, result) as each stage completes:
+    admitted (empty; the image is decoded and holds its memory reservation), characteristics, detections,
+    score, annotated_image (if requested), recommendations.
+    Consumers should close the generator (contextlib.aclosing) so the memory reservation is released promptly.
+    """
+    async with MemoryReservation(memory_budget) as reservation:
+        # Validate and decode image, admitting the request against the memory budget
+        image = await decode_image(content, reservation, payload.return_annotated_image)
+        pixels = image.width * image.height
+        yield "admitted", {}
+        
+        # Analyze beach characteristics
+        with pipeline_stage("characteristics", pixels):
+            beach_characteristics = analyze_beach_characteristics(image)
+        yield "characteristics", {"beach_characteristics": beach_characteristics}
         
         # Distinguish natural vs artificial elements
-        natural_artificial = distinguish_natural_vs_artificial(image)
+        # This runs first so that it can act as the cheap first stage of the cascade.
+        with pipeline_stage("natural_artificial", pixels):
+            natural_artificial = distinguish_natural_vs_artificial(image)
+        
+        # Early exit: clearly clean beaches skip the per-category scan and localization
+        early_exit = EARLY_EXIT_ENABLED and payload.allow_early_exit and is_clearly_clean(natural_artificial)
+        cascade_stats["requests"] += 1
+        if early_exit:
+            cascade_stats["early_exits"] += 1
+            detected_objects = []
+        else:
+            # Detect trash objects with locations
+            with pipeline_stage("detection", pixels):
+                detected_objects = detect_trash_objects_with_location(image)
+        yield "detections", {
+            "detected_objects": [format_detection(obj) for obj in detected_objects],
+            "early_exit": early_exit
+        }
         
         # Calculate sophisticated cleanliness score
         score, detailed_analysis = calculate_advanced_cleanliness_score(
             detected_objects, beach_characteristics, natural_artificial
         )
-        
-        # Generate annotated image if requested
-        annotated_image_base64 = None
-        if payload.return_annotated_image:
-            annotated_image = annotate_image_with_detections(image, detected_objects)
-            annotated_image_base64 = image_to_base64(annotated_image)
+        detailed_analysis["early_exit"] = early_exit
+        detailed_analysis["clean_confidence"] = natural_artificial["clean_confidence"]
         
         # Generate response category
         category = categorize_cleanliness(score)
-
-        # Generate recommendations using LLM
-        recommendations = await get_recommendations_from_llm(
-            score, category, detected_objects, beach_characteristics, detailed_analysis
-        )
         
         # Calculate overall confidence (average of detected object confidences, or a default if no objects)
         overall_confidence = np.mean([obj["confidence"] for obj in detected_objects]) if detected_objects else 0.85
+        yield "score", {
+            "cleanliness_score": round(score, 2),
+            "category": category,
+            "overall_confidence": round(float(overall_confidence), 3),
+            "detailed_analysis": detailed_analysis
+        }
+        
+        # Persist embeddings for offline re-scoring (computed already, so this is only a small write)
+        embedding_store = get_embedding_store()
+        if embedding_store is not None:
+            try:
+                embedding_store.append(image_content_key(content), image_embeddings(image), {
+                    "image_url": payload.image_url,
+                    "width": image.width,
+                    "height": image.height,
+                    "analyzed_at": time.time(),
+                    "cleanliness_score": round(score, 2)
+                })
+            except Exception as e:
+                print(f"Failed to store embeddings: {e}")
+        
+        # Generate annotated image if requested
+        if payload.return_annotated_image:
+            with pipeline_stage("annotation", pixels):
+                annotated_image = annotate_image_with_detections(image, detected_objects)
+                annotated_image_base64 = image_to_base64(annotated_image)
+                del annotated_image
+            yield "annotated_image", {"annotated_image_base64": annotated_image_base64}
         
-        return AnalysisResponse(
-            cleanliness_score=round(score, 2),
-            category=category,
-            overall_confidence=round(overall_confidence, 3),
-            detected_objects=[
-                ObjectDetection(
-                    category=obj["category"],
-                    confidence=round(obj["confidence"], 3),
-                    severity=obj["severity"],
-                    description=obj["description"],
-                    bounding_box=BoundingBox(**obj["bounding_box"]) if obj["bounding_box"] else None
-                ) for obj in detected_objects
-            ],
-            beach_characteristics=beach_characteristics,
-            detailed_analysis=detailed_analysis,
-            recommendations=recommendations,
-            annotated_image_base64=annotated_image_base64
+        # Drop the decoded image before the LLM call so the released budget is really free
+        del image
+    
+    # Generate recommendations using LLM
+    recommendations = await get_recommendations_from_llm(
+        score, category, detected_objects, beach_characteristics, detailed_analysis
+    )
+    yield "recommendations", {"recommendations": recommendations}
+
+async def analyze_image_content(content: bytes, payload: AnalyzeRequest) -> AnalysisResponse:
+    """Run the full analysis pipeline on downloaded image bytes and assemble the response."""
+    result = {}
+    async with aclosing(analysis_stages(content, payload)) as stages:
+        async for _, stage_result in stages:
+            result.update(stage_result)
+    result.pop("early_exit") # Already part of detailed_analysis
+    return AnalysisResponse(**result)
+
+def analysis_options(payload: AnalyzeRequest) -> Tuple:
+    """Request options that change the analysis result, used in single-flight keys."""
+    return (payload.return_annotated_image, payload.allow_early_exit)
+
+async def analyze_url(payload: AnalyzeRequest) -> AnalysisResponse:
+    """Download the image, then coalesce on its content so identical bytes from different URLs are analyzed once."""
+    content = await fetch_image_bytes(payload.image_url)
+    return await analysis_flights.do(
+        ("analyze-content", image_content_key(content), analysis_options(payload)),
+        lambda: analyze_image_content(content, payload)
+    )
+
+def check_profile_token(token: Optional[str]):
+    if not PROFILING_TOKEN or not token or not hmac.compare_digest(token, PROFILING_TOKEN):
+        raise HTTPException(status_code=403, detail="Profiling is disabled or the profile token is invalid")
+
+def save_profile_trace(prof, trace_id: str) -> str:
+    """Write a Chrome trace (chrome://tracing, Perfetto) and keep only the newest PROFILE_MAX_TRACES."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{trace_id}.json")
+    prof.export_chrome_trace(path)
+
+    traces = sorted(
+        (os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith(".json")),
+        key=os.path.getmtime
+    )
+    for old_path in traces[:-PROFILE_MAX_TRACES]:
+        os.remove(old_path)
+    return path
+
+async def analyze_with_profile(payload: AnalyzeRequest) -> AnalysisResponse:
+    """
+    Run one request under the PyTorch profiler, recording operator timings, shapes and Python stacks,
+    and attach the id of the stored Chrome trace. Profiled requests are never coalesced.
+    The profiler is process-wide, so ops from other requests running concurrently may appear in the trace.
+    """
+    if profiling_lock.locked():
+        raise HTTPException(status_code=409, detail="Another profiled request is in progress; retry later")
+    
+    async with profiling_lock:
+        trace_id = uuid.uuid4().hex
+        marker = profiling_active.set(True)
+        try:
+            with torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU],
+                record_shapes=True,
+                with_stack=True
+            ) as prof:
+                content = await fetch_image_bytes(payload.image_url)
+                response = await analyze_image_content(content, payload)
+        finally:
+            profiling_active.reset(marker)
+        save_profile_trace(prof, trace_id)
+    
+    response.profile_trace_id = trace_id
+    return response
+
+@app.post("/analyze", response_model=AnalysisResponse)
+async def analyze_beach_cleanliness(payload: AnalyzeRequest, request: Request):
+    """
+    Advanced beach cleanliness analysis with detailed object detection.
+    Returns comprehensive analysis with accurate scoring and AI-generated recommendations.
+    Concurrent identical requests share a single computation.
+    Requests carrying a valid profile token (X-Profile-Token header or profile_token field) are profiled.
+    """
+    try:
+        profile_token = request.headers.get("X-Profile-Token") or payload.profile_token
+        if profile_token:
+            check_profile_token(profile_token)
+            return await analyze_with_profile(payload)
+        
+        return await analysis_flights.do(
+            ("analyze-url", payload.image_url, analysis_options(payload)),
+            lambda: analyze_url(payload)
         )
         
     except HTTPException:
@@ -800,29 +1656,87 @@ async def analyze_beach_cleanliness(payload: AnalyzeRequest):
         # Catch any other unexpected errors and return a 500
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
-@app.post("/analyze-image")
-async def analyze_image_endpoint(payload: AnalyzeRequest):
+def format_sse(event: str, data: Dict) -> str:
+    """Encode one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/analyze-stream")
+async def analyze_stream(payload: AnalyzeRequest):
     """
-    Analyze image and return annotated image as downloadable file.
-    This endpoint is separate for direct image download without full analysis response.
+    Progressive variant of /analyze using server-sent events.
+    Emits characteristics, detections, score, annotated_image (if requested) and recommendations
+    as each stage completes, then done. Failures after the stream has started are sent as an error event.
     """
+    # Download, decode and admission errors (400, 413, 503 with Retry-After) are reported
+    # as a normal HTTP error, before the stream starts
+    content = await fetch_image_bytes(payload.image_url)
+    stages = analysis_stages(content, payload)
     try:
-        # Download and validate image
-        image = await download_image(payload.image_url)
+        await stages.__anext__() # admitted
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+    
+    async def event_stream():
+        try:
+            async with aclosing(stages):
+                async for stage, result in stages:
+                    yield format_sse(stage, result)
+        except HTTPException as e:
+            yield format_sse("error", {"status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            yield format_sse("error", {"status_code": 500, "detail": f"Analysis failed: {str(e)}"})
+        else:
+            yield format_sse("done", {})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} # Disable proxy buffering
+    )
+
+async def annotate_image_content(content: bytes) -> bytes:
+    """Detect objects in downloaded image bytes and return the annotated image as JPEG bytes."""
+    async with MemoryReservation(memory_budget) as reservation:
+        # Validate and decode image, admitting the request against the memory budget
+        image = await decode_image(content, reservation)
+        pixels = image.width * image.height
         
         # Detect trash objects with locations
-        detected_objects = detect_trash_objects_with_location(image)
+        with pipeline_stage("detection", pixels):
+            detected_objects = detect_trash_objects_with_location(image)
         
         # Generate annotated image
-        annotated_image = annotate_image_with_detections(image, detected_objects)
-        
-        # Convert to bytes for streaming
-        img_buffer = BytesIO()
-        annotated_image.save(img_buffer, format="JPEG", quality=85)
-        img_buffer.seek(0)
+        with pipeline_stage("annotation", pixels):
+            annotated_image = annotate_image_with_detections(image, detected_objects)
+            
+            # Convert to bytes for streaming
+            img_buffer = BytesIO()
+            annotated_image.save(img_buffer, format="JPEG", quality=85)
+            return img_buffer.getvalue()
+
+async def annotate_url(url: str) -> bytes:
+    content = await fetch_image_bytes(url)
+    return await analysis_flights.do(
+        ("annotate-content", image_content_key(content)),
+        lambda: annotate_image_content(content)
+    )
+
+@app.post("/analyze-image")
+async def analyze_image_endpoint(payload: AnalyzeRequest):
+    """
+    Analyze image and return annotated image as downloadable file.
+    This endpoint is separate for direct image download without full analysis response.
+    """
+    try:
+        image_bytes = await analysis_flights.do(
+            ("annotate-url", payload.image_url),
+            lambda: annotate_url(payload.image_url)
+        )
         
         return StreamingResponse(
-            BytesIO(img_buffer.getvalue()),
+            BytesIO(image_bytes),
             media_type="image/jpeg",
             headers={"Content-Disposition": "attachment; filename=annotated_beach.jpg"}
         )
@@ -832,11 +1746,53 @@ async def analyze_image_endpoint(payload: AnalyzeRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Image analysis failed: {str(e)}")
 
+@app.get("/profiles/{trace_id}")
+async def get_profile(trace_id: str, request: Request):
+    """Download the Chrome trace recorded for a profiled request"""
+    check_profile_token(request.headers.get("X-Profile-Token"))
+    path = os.path.join(PROFILE_DIR, f"{trace_id}.json")
+    if not (len(trace_id) == 32 and all(c in "0123456789abcdef" for c in trace_id)) or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json", filename=f"profile_{trace_id}.json")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "model": "CLIP-ViT-B/32", "version": "3.0"}
 
+@app.get("/stats")
+async def get_stats():
+    """Runtime statistics for the analysis pipeline"""
+    requests_seen = cascade_stats["requests"]
+    return {
+        "early_exit": {
+            "enabled": EARLY_EXIT_ENABLED,
+            "clean_confidence_threshold": EARLY_EXIT_CLEAN_CONFIDENCE,
+            "min_natural_ratio": EARLY_EXIT_MIN_NATURAL_RATIO,
+            "requests": requests_seen,
+            "early_exits": cascade_stats["early_exits"],
+            "exit_rate": cascade_stats["early_exits"] / requests_seen if requests_seen else 0.0
+        },
+        "memory": {
+            "budget_mb": MEMORY_BUDGET_MB,
+            "in_use_mb": memory_budget.in_use / 2**20,
+            "queued_now": memory_budget.queued,
+            **memory_budget.stats,
+            "stage_tracking_enabled": memory_sampler.enabled,
+            "stages": stage_memory
+        },
+        "llm": {
+            "circuit_state": llm_breaker.state,
+            "recommendations_from_llm": llm_stats["llm"],
+            "recommendations_from_fallback": llm_stats["fallback"],
+            **llm_breaker.stats
+        },
+        "single_flight": {
+            "in_flight": analysis_flights.in_flight,
+            **analysis_flights.stats
+        }
+    }
+
 @app.get("/categories")
 async def get_categories():
     """Get information about detection categories and scoring"""
@@ -855,6 +1811,11 @@ async def get_categories():
             "footwear": {"severity": 4, "description": "Footwear"},
             "clothing": {"severity": 5, "description": "Clothing and textiles"}
         },
+        "detection": {
+            "method": "Per-category prompt ensembles scored in one step; thresholds are on cosine similarity",
+            "confidence": "Margin of the similarity over the category threshold on CLIP's logit scale (0.5 at the threshold)",
+            "thresholds": CATEGORY_THRESHOLDS
+        },
         "scoring_system": {
             "base_score": 100,
             "natural_elements_bonus": "Up to 10 points for high natural ratio",
@@ -880,8 +1841,11 @@ async def root():
         ],
         "endpoints": {
             "analyze": "/analyze - POST: Analyze beach cleanliness with optional annotated image",
+            "analyze-stream": "/analyze-stream - POST: Progressive analysis as server-sent events",
             "analyze-image": "/analyze-image - POST: Get annotated image as downloadable file",
             "categories": "/categories - GET: Detection categories info",
+            "profiles": "/profiles/{id} - GET: Chrome trace of a profiled /analyze request (requires X-Profile-Token)",
+            "stats": "/stats - GET: Pipeline statistics (early-exit rate, memory budget, request coalescing, LLM health)",
             "health": "/health - - GET: Health check",
             "docs": "/docs - GET: API documentation"
         },
@@ -0,0 +1,47 @@
+"""
+Offline re-scoring from the embedding store.
+
+Recomputes characteristics, detections and cleanliness scores for every image in the
+embedding store using the current prompts, thresholds and scoring, without running the
+CLIP vision model again. Writes one JSON object per image. The store is opened read-only,
+so this can run while the service is still appending to it.
+
+With --calibrate-rate, instead writes per-category detection thresholds on cosine similarity
+(for CATEGORY_THRESHOLDS_PATH) at which each category fires on that fraction of stored images.
+
+Example:
+    python rescore.py --out rescored.jsonl
+    python rescore.py --calibrate-rate 0.2 --out category_thresholds.json
+"""
+import argparse
+import json
+import sys
+
+import main
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Re-score stored images from their CLIP embeddings")
+    parser.add_argument("--store-dir", default=main.EMBEDDING_STORE_DIR or main.DEFAULT_EMBEDDING_STORE_DIR, help="Embedding store directory")
+    parser.add_argument("--out", help="Output JSONL file (default: stdout)")
+    parser.add_argument("--batch-size", type=int, default=1024, help="Images scored per vectorized batch")
+    parser.add_argument("--no-early-exit", action="store_true", help="Run localization for every image")
+    parser.add_argument("--calibrate-rate", type=float, help="Write per-category thresholds firing on this fraction of images")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = main.EmbeddingStore(args.store_dir, main.CLIP_EMBEDDING_DIM, main.CLIP_NUM_PATCHES, read_only=True)
+    out = open(args.out, "w") if args.out else sys.stdout
+    try:
+        if args.calibrate_rate is not None:
+            json.dump(main.calibrate_category_thresholds(store, args.calibrate_rate), out, indent=2)
+            print(f"Calibrated thresholds from {len(store)} images in {args.store_dir}", file=sys.stderr)
+        else:
+            count = 0
+            for result in main.rescore_stored_embeddings(store, args.batch_size, not args.no_early_exit):
+                out.write(json.dumps(result) + "\n")
+                count += 1
+            print(f"Re-scored {count} images from {args.store_dir}", file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
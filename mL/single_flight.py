@@ -0,0 +1,40 @@
+import asyncio
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller for a key starts the computation
+    in its own task and later callers await the same task instead of repeating the work.
+    Waiters are shielded from each other, so one client disconnecting does not cancel the
+    shared computation; it is only cancelled once every waiter has gone. A failure is
+    propagated to all current waiters and is not cached.
+    """
+    def __init__(self):
+        self._calls = {} # key -> [task, waiter count]
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key, func):
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(func())
+            call = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is call else None)
+            self.stats["leaders"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        
+        task = call[0]
+        call[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if call[1] == 1 and not task.done():
+                # Last interested caller gave up; new callers must not join the cancelled task
+                self._calls.pop(key, None)
+                task.cancel()
+            raise
+        finally:
+            call[1] -= 1
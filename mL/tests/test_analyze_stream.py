@@ -0,0 +1,30 @@
+import pytest
+
+pytest.importorskip("httpx") # fastapi.testclient
+
+from fastapi.testclient import TestClient
+
+import main
+
+def stream_with_content(monkeypatch, content: bytes):
+    async def fetch_image_bytes(url):
+        return content
+    monkeypatch.setattr(main, "fetch_image_bytes", fetch_image_bytes)
+    with TestClient(main.app) as client:
+        return client.post("/analyze-stream", json={"image_url": "http://example.com/beach.jpg"})
+
+def test_invalid_image_keeps_its_status_code(monkeypatch):
+    response = stream_with_content(monkeypatch, b"not an image")
+    assert response.status_code == 400
+    assert not response.headers["content-type"].startswith("text/event-stream")
+
+def test_full_admission_queue_keeps_retry_after(monkeypatch):
+    async def acquire(nbytes):
+        raise main.HTTPException(status_code=503, detail="busy", headers={"Retry-After": "30"})
+    monkeypatch.setattr(main.memory_budget, "acquire", acquire)
+    image = main.Image.new("RGB", (200, 200))
+    buffer = main.BytesIO()
+    image.save(buffer, format="PNG")
+    response = stream_with_content(monkeypatch, buffer.getvalue())
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
@@ -0,0 +1,63 @@
+from typing import Tuple
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+def make_breaker(monkeypatch) -> Tuple[CircuitBreaker, Clock]:
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", clock)
+    return CircuitBreaker(failure_threshold=2, cooldown=30), clock
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow_request() == (True, False)
+        breaker.record_failure()
+
+def test_opens_after_consecutive_failures_and_fails_fast(monkeypatch):
+    breaker, clock = make_breaker(monkeypatch)
+    breaker.record_failure()
+    breaker.record_success() # Resets the count
+    open_breaker(breaker)
+    assert breaker.state == "open"
+    clock.now += 29
+    assert breaker.allow_request() == (False, False)
+    assert breaker.stats["short_circuited"] == 1
+
+def test_probe_after_cooldown_closes_on_success(monkeypatch):
+    breaker, clock = make_breaker(monkeypatch)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow_request() == (True, True)
+    assert breaker.state == "half_open"
+    assert breaker.allow_request() == (False, False) # Only one probe at a time
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow_request() == (True, False)
+
+def test_failed_probe_reopens_for_a_full_cooldown(monkeypatch):
+    breaker, clock = make_breaker(monkeypatch)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow_request() == (True, True)
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 29
+    assert breaker.allow_request() == (False, False)
+    clock.now += 1
+    assert breaker.allow_request() == (True, True)
+
+def test_released_probe_lets_the_next_call_probe(monkeypatch):
+    breaker, clock = make_breaker(monkeypatch)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow_request() == (True, True)
+    breaker.release_probe()
+    assert breaker.state == "half_open"
+    assert breaker.stats["failures"] == breaker.failure_threshold
+    assert breaker.allow_request() == (True, True)
@@ -0,0 +1,15 @@
+import torch
+
+import main
+
+def test_confidence_grows_with_the_margin_over_the_threshold():
+    thresholds = torch.tensor([0.25, 0.25, 0.25, 0.25])
+    similarities = torch.tensor([[0.24, 0.25, 0.26, 0.30]])
+    confidences = main.category_confidences(similarities, thresholds)[0]
+    assert confidences[1].item() == 0.5
+    assert confidences[0] < confidences[1] < confidences[2] < confidences[3]
+    assert confidences[2].item() < 0.9 # A borderline hit is not reported as certain
+
+def test_default_thresholds_lower_with_severity():
+    thresholds = [main.detection_threshold(severity) for severity in range(1, 11)]
+    assert thresholds == sorted(thresholds, reverse=True)
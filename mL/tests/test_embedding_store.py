@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+import numpy as np
+import torch
+
+import main
+
+DIM, PATCHES = 4, 3
+
+def embeddings(value: float) -> "main.ImageEmbeddings":
+    return main.ImageEmbeddings(torch.full((DIM,), value), torch.full((PATCHES, DIM), value))
+
+def test_rows_stay_aligned_after_a_failed_append(tmp_path, monkeypatch):
+    store = main.EmbeddingStore(str(tmp_path), DIM, PATCHES)
+    store.append("a", embeddings(1.0), {})
+
+    original_write_row = store._write_row
+    def failing_write_row(path, row):
+        if path == store.patches_path:
+            raise OSError("disk full")
+        original_write_row(path, row)
+    monkeypatch.setattr(store, "_write_row", failing_write_row)
+    with pytest.raises(OSError):
+        store.append("b", embeddings(2.0), {})
+    monkeypatch.undo()
+
+    store.append("c", embeddings(3.0), {})
+    index, pooled, patches = main.EmbeddingStore(str(tmp_path), DIM, PATCHES).load()
+    assert [entry["id"] for entry in index] == ["a", "c"]
+    np.testing.assert_array_equal(pooled[:, 0], [1.0, 3.0])
+    np.testing.assert_array_equal(patches[:, 0, 0], [1.0, 3.0])
+
+def test_partial_index_line_is_discarded_on_open(tmp_path):
+    store = main.EmbeddingStore(str(tmp_path), DIM, PATCHES)
+    store.append("a", embeddings(1.0), {})
+    store.append("b", embeddings(2.0), {})
+    # Simulate a crash in the middle of writing the second index line
+    with open(store.index_path, "rb+") as f:
+        f.truncate(len(f.readline()) + 5)
+
+    reopened = main.EmbeddingStore(str(tmp_path), DIM, PATCHES)
+    assert len(reopened) == 1
+    reopened.append("b", embeddings(2.0), {})
+    index, pooled, _ = main.EmbeddingStore(str(tmp_path), DIM, PATCHES).load()
+    assert [entry["id"] for entry in index] == ["a", "b"]
+    np.testing.assert_array_equal(pooled[:, 0], [1.0, 2.0])
+
+def test_calibrated_thresholds_fire_at_the_target_rate(tmp_path, monkeypatch):
+    generator = torch.Generator().manual_seed(0)
+    class_embeds = torch.randn(len(main.TRASH_CATEGORIES), DIM, generator=generator)
+    monkeypatch.setattr(main, "category_ensemble_embeddings", lambda: class_embeds / class_embeds.norm(dim=-1, keepdim=True))
+    store = main.EmbeddingStore(str(tmp_path), DIM, PATCHES)
+    for i in range(200):
+        store.append(str(i), main.ImageEmbeddings(torch.randn(DIM, generator=generator), torch.zeros(PATCHES, DIM)), {})
+
+    thresholds = main.calibrate_category_thresholds(store, target_rate=0.2)
+    _, pooled, _ = store.load()
+    similarities = main.category_similarities(torch.from_numpy(np.asarray(pooled, dtype=np.float32)))
+    fire_rates = (similarities > torch.tensor(list(thresholds.values()))).double().mean(dim=0)
+    np.testing.assert_allclose(fire_rates.numpy(), 0.2, atol=0.01)
+
+def test_store_that_fails_to_open_is_disabled_once(tmp_path, monkeypatch, capsys):
+    blocker = tmp_path / "not_a_directory"
+    blocker.write_text("")
+    monkeypatch.setattr(main, "EMBEDDING_STORE_DIR", str(blocker / "embeddings"))
+    monkeypatch.setattr(main, "_embedding_store", None)
+    monkeypatch.setattr(main, "_embedding_store_disabled", False)
+
+    assert main.get_embedding_store() is None
+    assert main.get_embedding_store() is None
+    assert capsys.readouterr().out.count("Embedding store disabled") == 1
+
+def test_read_only_open_leaves_an_in_progress_append_alone(tmp_path):
+    store = main.EmbeddingStore(str(tmp_path), DIM, PATCHES)
+    store.append("a", embeddings(1.0), {})
+    # The writer is part-way through appending "b": its pooled row and part of its index line are on disk
+    store._write_row(store.pooled_path, embeddings(2.0).pooled.numpy().astype(np.float16))
+    with open(store.index_path, "a") as f:
+        f.write('{"id": "b"')
+    sizes = [os.path.getsize(path) for path in (store.pooled_path, store.patches_path, store.index_path)]
+
+    reader = main.EmbeddingStore(str(tmp_path), DIM, PATCHES, read_only=True)
+    index, pooled, patches = reader.load()
+    assert [entry["id"] for entry in index] == ["a"]
+    assert pooled.shape == (1, DIM) and patches.shape == (1, PATCHES, DIM)
+    assert [os.path.getsize(path) for path in (store.pooled_path, store.patches_path, store.index_path)] == sizes
+    with pytest.raises(RuntimeError):
+        reader.append("c", embeddings(3.0), {})
@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from aiohttp import web
+
+from llm_client import RetryableLLMError, call_gemini
+
+async def serve(handler):
+    app = web.Application()
+    app.router.add_post("/generate", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/generate"
+
+def test_returns_text_after_transient_errors():
+    async def scenario():
+        calls = 0
+        async def handler(request):
+            nonlocal calls
+            calls += 1
+            if calls < 3:
+                return web.Response(status=503)
+            return web.json_response({"candidates": [{"content": {"parts": [{"text": "ok"}]}}]})
+        runner, url = await serve(handler)
+        try:
+            text = await call_gemini(url, {}, time.monotonic() + 5, attempt_timeout=1, max_retries=2, retry_base_delay=0.01)
+        finally:
+            await runner.cleanup()
+        return text, calls
+
+    assert asyncio.run(scenario()) == ("ok", 3)
+
+def test_stops_after_max_retries():
+    async def scenario():
+        calls = 0
+        async def handler(request):
+            nonlocal calls
+            calls += 1
+            return web.Response(status=429)
+        runner, url = await serve(handler)
+        try:
+            with pytest.raises(RetryableLLMError):
+                await call_gemini(url, {}, time.monotonic() + 5, attempt_timeout=1, max_retries=2, retry_base_delay=0.01)
+        finally:
+            await runner.cleanup()
+        return calls
+
+    assert asyncio.run(scenario()) == 3
+
+def test_retries_stop_at_the_deadline():
+    async def scenario():
+        async def handler(request):
+            await asyncio.sleep(0.4) # Outlasts every attempt timeout
+            return web.Response(status=200)
+        runner, url = await serve(handler)
+        started = time.monotonic()
+        try:
+            with pytest.raises(RetryableLLMError):
+                await call_gemini(url, {}, started + 0.5, attempt_timeout=0.2, max_retries=100, retry_base_delay=0.05)
+        finally:
+            await runner.cleanup()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 1.0
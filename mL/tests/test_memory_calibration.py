@@ -0,0 +1,36 @@
+import pytest
+
+import main
+
+@pytest.fixture
+def characteristics(monkeypatch):
+    entry = {"bytes_per_pixel": main.DEFAULT_STAGE_BYTES_PER_PIXEL["characteristics"], "samples": 0,
+             "max_observed_bytes_per_pixel": 0.0, "last_peak_mb": 0.0}
+    monkeypatch.setitem(main.stage_memory, "characteristics", entry)
+    return entry
+
+def test_fixed_cost_on_a_small_image_does_not_inflate_the_estimate(characteristics):
+    # Tens of MB of model/caches on a 100x100 image is within the per-request overhead, not per-pixel cost
+    main.update_stage_estimate("characteristics", 40 * 2**20, 100 * 100)
+    assert characteristics["bytes_per_pixel"] == main.DEFAULT_STAGE_BYTES_PER_PIXEL["characteristics"]
+
+def test_one_sample_moves_the_estimate_by_at_most_the_max_step(characteristics):
+    before = characteristics["bytes_per_pixel"]
+    main.update_stage_estimate("characteristics", int(main.MEMORY_REQUEST_OVERHEAD_MB * 2**20) + 10**9, 1000 * 1000)
+    assert characteristics["bytes_per_pixel"] == pytest.approx(before * main.MEMORY_CALIBRATION_MAX_STEP)
+
+def test_warm_up_samples_are_not_calibrated(characteristics, monkeypatch):
+    class Sampler:
+        enabled = True
+        def reset(self):
+            return 0
+        def peak(self):
+            return 10**10
+    monkeypatch.setattr(main, "memory_sampler", Sampler())
+    for _ in range(main.MEMORY_CALIBRATION_WARMUP):
+        with main.memory_stage("characteristics", 1000 * 1000):
+            pass
+    assert characteristics["bytes_per_pixel"] == main.DEFAULT_STAGE_BYTES_PER_PIXEL["characteristics"]
+    with main.memory_stage("characteristics", 1000 * 1000):
+        pass
+    assert characteristics["bytes_per_pixel"] > main.DEFAULT_STAGE_BYTES_PER_PIXEL["characteristics"]
@@ -0,0 +1,32 @@
+import numpy as np
+
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+import main
+
+def random_images():
+    rng = np.random.default_rng(0)
+    sizes = [(640, 480), (300, 900), (224, 224), (1000, 1000), (257, 513)]
+    return [Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8)) for width, height in sizes]
+
+def test_preprocess_images_matches_clip_image_processor():
+    images = random_images()
+    reference = CLIPImageProcessor.from_pretrained("openai/clip-vit-base-patch32")
+    expected = reference(images=images, return_tensors="np")["pixel_values"]
+
+    actual = main.preprocess_images(images).numpy()
+
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-6)
+
+def test_preprocess_images_reuses_output_buffer():
+    images = random_images()
+    out = np.empty((len(images), 3, *main.CLIP_CROP_SIZE), dtype=np.float32)
+
+    first = main.preprocess_images(images, out=out)
+    second = main.preprocess_images(images[::-1], out=out)
+
+    assert np.shares_memory(first.numpy(), out)
+    assert np.shares_memory(second.numpy(), out)
+    np.testing.assert_array_equal(out[0], main.preprocess_images([images[-1]]).numpy()[0])
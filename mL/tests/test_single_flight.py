@@ -0,0 +1,88 @@
+import asyncio
+
+from single_flight import SingleFlight
+
+def test_concurrent_callers_share_one_computation():
+    async def scenario():
+        flights = SingleFlight()
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*(flights.do("key", compute) for _ in range(5)))
+        return calls, results, flights
+
+    calls, results, flights = asyncio.run(scenario())
+    assert calls == 1
+    assert results == ["result"] * 5
+    assert flights.stats == {"leaders": 1, "coalesced": 4}
+    assert flights.in_flight == 0
+
+def test_one_waiter_cancelling_does_not_affect_others():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def compute():
+            await asyncio.sleep(0.05)
+            return "result"
+
+        first = asyncio.ensure_future(flights.do("key", compute))
+        second = asyncio.ensure_future(flights.do("key", compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first.cancelled()
+
+    result, first_cancelled = asyncio.run(scenario())
+    assert result == "result"
+    assert first_cancelled
+
+def test_caller_arriving_after_last_waiter_cancels_gets_fresh_computation():
+    async def scenario():
+        flights = SingleFlight()
+        started = 0
+
+        async def compute():
+            nonlocal started
+            started += 1
+            try:
+                await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                await asyncio.sleep(0.01) # Cancellation takes a moment to complete
+                raise
+            return "result"
+
+        first = asyncio.ensure_future(flights.do("key", compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0) # Let the cancellation reach the shared task, which is still winding down
+        result = await flights.do("key", compute)
+        return result, started
+
+    result, started = asyncio.run(scenario())
+    assert result == "result"
+    assert started == 2
+
+def test_failure_reaches_all_waiters_and_is_not_cached():
+    async def scenario():
+        flights = SingleFlight()
+        attempts = 0
+
+        async def compute():
+            nonlocal attempts
+            attempts += 1
+            await asyncio.sleep(0.01)
+            if attempts == 1:
+                raise ValueError("boom")
+            return "result"
+
+        failures = await asyncio.gather(*(flights.do("key", compute) for _ in range(3)), return_exceptions=True)
+        retry = await flights.do("key", compute)
+        return failures, retry
+
+    failures, retry = asyncio.run(scenario())
+    assert all(isinstance(f, ValueError) for f in failures)
+    assert retry == "result"